@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+"""
+Salted password hashes for the users file, and signed session tokens.
+
+    python3 auth_utils.py users_file.txt hashed_users.txt [--scheme scrypt]
+
+writes a copy of a users file with every plaintext password replaced by
+its hash. The server accepts both kinds of entries in the same file.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+PBKDF2_ITERATIONS = 100000
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+SALT_SIZE = 16
+HASH_SCHEMES = ("pbkdf2_sha256", "scrypt")
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def hash_password(password, scheme="pbkdf2_sha256"):
+    """
+    A salted hash of password, in the form the users file stores:
+    pbkdf2_sha256$iterations$salt$hash or scrypt$n$r$p$salt$hash.
+    """
+    salt = os.urandom(SALT_SIZE)
+    if scheme == "scrypt":
+        digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${b64encode(salt)}${b64encode(digest)}"
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${b64encode(salt)}${b64encode(digest)}"
+
+
+def is_hashed(stored):
+    """True if a users file entry holds a hash rather than a plaintext password."""
+    return stored.split("$", 1)[0] in HASH_SCHEMES
+
+
+def verify_password(stored, password):
+    """
+    Check password against a users file entry, hashed or plaintext.
+    The final comparison takes the same time wherever the inputs differ.
+    Hashed entries take tens of milliseconds, so the server runs this on its
+    offload pool.
+    """
+    if not isinstance(password, str):
+        return False
+    parts = stored.split("$")
+    try:
+        if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+            expected = base64.b64decode(parts[3])
+            digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), base64.b64decode(parts[2]), int(parts[1]))
+        elif parts[0] == "scrypt" and len(parts) == 6:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            expected = base64.b64decode(parts[5])
+            digest = hashlib.scrypt(password.encode("utf-8"), salt=base64.b64decode(parts[4]), n=n, r=r, p=p,
+                                    maxmem=2 * 128 * r * (n + p + 1), dklen=len(expected))
+        else:
+            return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+    except ValueError:
+        return False  # A malformed hash matches nothing
+    return hmac.compare_digest(digest, expected)
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64url_decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def make_session_token(key, username, ttl, now=None):
+    """
+    A token that proves username logged in, valid for ttl seconds:
+    payload.signature, where payload is the username and expiry time as
+    JSON and signature its HMAC-SHA256 under key. Any server process with
+    the same key can check it without shared state.
+    """
+    expires = int((time.time() if now is None else now) + ttl)
+    payload = json.dumps({"u": username, "e": expires}, separators=(",", ":")).encode("utf-8")
+    signature = hmac.new(key, payload, hashlib.sha256).digest()
+    return f"{b64url(payload)}.{b64url(signature)}"
+
+
+def check_session_token(key, token, now=None):
+    """The username a token made by make_session_token was issued to, or None if it is forged, malformed or expired."""
+    if not isinstance(token, str) or token.count(".") != 1:
+        return None
+    payload, signature = token.split(".")
+    try:
+        payload, signature = b64url_decode(payload), b64url_decode(signature)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(hmac.new(key, payload, hashlib.sha256).digest(), signature):
+        return None
+    try:
+        claims = json.loads(payload)
+        username, expires = claims["u"], claims["e"]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(expires, int) or expires <= (time.time() if now is None else now):
+        return None
+    return username
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replace the plaintext passwords of a users file with salted hashes")
+    parser.add_argument("users_file", help="username<TAB>password per line")
+    parser.add_argument("output", help="Path of the hashed users file to write")
+    parser.add_argument("--scheme", choices=HASH_SCHEMES, default="pbkdf2_sha256", help="Hash function (default: pbkdf2_sha256)")
+    args = parser.parse_args()
+    count = 0
+    with open(args.users_file, "r", encoding="utf-8") as source, open(args.output, "w", encoding="utf-8") as output:
+        for line in source:
+            parts = line.strip().split("\t")
+            if len(parts) != 2:
+                continue
+            username, password = parts[0].strip(), parts[1].strip()
+            if not is_hashed(password):
+                password = hash_password(password, args.scheme)
+            output.write(f"{username}\t{password}\n")
+            count += 1
+    print(f"Wrote {count} users to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,529 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the server.
+
+    python3 benchmarks.py load --port 1337 --clients 20 --duration 10
+
+Run a benchmark with --help to see its options.
+"""
+import argparse
+import functools
+import json
+import os
+import random
+import socket
+import string
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from test_client import TestClient, DEFAULT_HOST, DEFAULT_PORT
+from buffer_utils import BufferPool, RecvBuffer
+from server_utils import load_users, handle_message, make_result_cache, SERVER_OPTIONS, lcm, lcm_list, caesar, caesar_chars, parentheses_depth_chars, CAESAR_ALPHABET, CAESAR_TABLES
+from vector_utils import lcm_many, parentheses_depth_array
+import vector_utils
+from parallel_utils import parallel_translate, start_tracker
+from concurrent.futures import ProcessPoolExecutor
+from user_store import UserStore, build_store
+
+
+def percentile(samples, fraction):
+    """Return the value below which the given fraction of the sorted samples fall."""
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(fraction * len(samples)))
+    return samples[index]
+
+
+def random_command():
+    """Build one small lcm/parentheses/caesar request, like the stress test does."""
+    kind = random.choice(["lcm", "parentheses", "caesar"])
+    if kind == "lcm":
+        return {"type": "lcm", "x": random.randint(1, 10 ** 6), "y": random.randint(1, 10 ** 6)}
+    if kind == "parentheses":
+        return {"type": "parentheses", "string": "".join(random.choice("()") for _ in range(random.randint(2, 40)))}
+    text = "".join(random.choice("abcdefghijklmnopqrstuvwxyz ") for _ in range(random.randint(5, 60)))
+    return {"type": "caesar", "text": text, "shift": random.randint(-25, 25)}
+
+
+def load_worker(args, latencies, errors, stop_at):
+    client = TestClient(args.host, args.port, args.username, args.password)
+    if not client.connect() or not client.authenticate():
+        errors.append("connect/authenticate failed")
+        return
+    samples = []
+    try:
+        while time.perf_counter() < stop_at:
+            message = json.dumps(random_command())
+            start = time.perf_counter()
+            if not client.send_message(message) or client.receive_response() is None:
+                errors.append("request failed")
+                break
+            samples.append(time.perf_counter() - start)
+    finally:
+        client.disconnect()
+        latencies.extend(samples)
+
+
+def run_load(args):
+    """
+    Closed-loop load generator: every client sends one request, waits for the
+    response and repeats. Reports throughput and latency percentiles, so two
+    server engines can be compared under the same load.
+    """
+    latencies = []
+    errors = []
+    stop_at = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=load_worker, args=(args, latencies, errors, stop_at)) for _ in range(args.clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"clients:     {args.clients}")
+    print(f"requests:    {len(latencies)} ({len(errors)} errors)")
+    print(f"throughput:  {len(latencies) / elapsed:.0f} req/s")
+    print(f"latency p50: {percentile(latencies, 0.50) * 1000:.3f} ms")
+    print(f"latency p99: {percentile(latencies, 0.99) * 1000:.3f} ms")
+    return 0 if not errors else 1
+
+
+def probe_worker(args, samples, stop):
+    """Send lcm/parentheses/caesar requests back to back, recording (send time, latency)."""
+    client = TestClient(args.host, args.port, args.username, args.password)
+    if not client.connect() or not client.authenticate():
+        return
+    try:
+        while not stop.is_set():
+            message = json.dumps(random_command())
+            start = time.perf_counter()
+            if not client.send_message(message) or client.receive_response() is None:
+                break
+            samples.append((start, time.perf_counter() - start))
+    finally:
+        client.disconnect()
+
+
+def login_worker(args, latencies, failures, count):
+    for _ in range(count):
+        client = TestClient(args.host, args.port, args.username, args.password)
+        start = time.perf_counter()
+        if client.connect() and client.authenticate():
+            latencies.append(time.perf_counter() - start)
+        else:
+            failures.append(1)
+        client.disconnect()
+
+
+def run_logins(args):
+    """
+    Login storm against a server whose users file holds password hashes
+    (see auth_utils.py). One client keeps sending commands the whole time;
+    its latency before and during the storm shows whether the event loop
+    stays responsive while the logins are verified on the pool.
+    """
+    samples = []
+    stop = threading.Event()
+    probe = threading.Thread(target=probe_worker, args=(args, samples, stop))
+    probe.start()
+    time.sleep(args.warmup)
+    storm_started = time.perf_counter()
+    latencies, failures = [], []
+    per_thread = args.logins // args.clients
+    threads = [threading.Thread(target=login_worker, args=(args, latencies, failures, per_thread)) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    storm_ended = time.perf_counter()
+    stop.set()
+    probe.join()
+
+    before = sorted(latency for start, latency in samples if start < storm_started)
+    during = sorted(latency for start, latency in samples if storm_started <= start < storm_ended)
+    latencies.sort()
+    print(f"logins:      {len(latencies)} in {storm_ended - storm_started:.2f} s ({len(failures)} failed), "
+          f"p50 {percentile(latencies, 0.50) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    for name, probe_latencies in [("before", before), ("during", during)]:
+        print(f"commands {name} the storm: {len(probe_latencies)} requests, "
+              f"p50 {percentile(probe_latencies, 0.50) * 1000:.3f} ms, p99 {percentile(probe_latencies, 0.99) * 1000:.3f} ms")
+    return 0 if not failures else 1
+
+
+def run_batch(args):
+    """
+    The same small lcm computations sent one per message and as batch
+    messages of --size commands. Single messages are pipelined --size at a
+    time, so both take the same number of round trips.
+    Start the server with --max-line large enough for a batch.
+    """
+    client = TestClient(args.host, args.port, args.username, args.password)
+    if not client.connect() or not client.authenticate():
+        print("connect/authenticate failed")
+        return 1
+    commands = [{"type": "lcm", "x": random.randint(1, 10 ** 6), "y": random.randint(1, 10 ** 6)} for _ in range(args.count)]
+    try:
+        started = time.perf_counter()
+        single = []
+        for i in range(0, args.count, args.size):
+            window = commands[i:i + args.size]
+            client.socket.sendall("".join(json.dumps(command) + "\n" for command in window).encode())
+            single.extend(client.receive_response() for _ in window)
+        single_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        batched = []
+        for i in range(0, args.count, args.size):
+            client.send_message(json.dumps({"type": "batch", "commands": commands[i:i + args.size]}))
+            response = client.receive_response()
+            if response is None or response.get("type") != "batch_result":
+                print(f"batch failed: {response}")
+                return 1
+            batched.extend(response["results"])
+        batch_elapsed = time.perf_counter() - started
+    finally:
+        client.disconnect()
+    if single != batched:
+        print("single and batched results differ")
+        return 1
+    print(f"{args.count} lcm commands")
+    print(f"one per message:     {args.count / single_elapsed:9.0f} commands/s")
+    print(f"batches of {args.size:<6}   {args.count / batch_elapsed:9.0f} commands/s")
+    return 0
+
+
+def legacy_read(sock, buf):
+    """The read path before RecvBuffer: recv, extend, copy each line out, delete the prefix."""
+    buf.extend(sock.recv(4096))
+    lines = []
+    while True:
+        nl_index = buf.find(b"\n")
+        if nl_index == -1:
+            return lines
+        lines.append(bytes(buf[:nl_index]))
+        del buf[:nl_index + 1]
+
+
+def recv_buffer_read(sock, buf):
+    """The current read path: recv_into the pooled buffer and split lines as memoryviews."""
+    buf.recv_from(sock)
+    lines = []
+    while True:
+        line = buf.next_line()
+        if line is None:
+            buf.trim()
+            return lines
+        lines.append(line)
+
+
+def feed_requests(read, buf, chunk, rounds, trace):
+    """
+    Send chunk through a socketpair rounds times, reading it back with read.
+    Returns (requests, seconds, bytes the read path allocated while tracing).
+    """
+    writer, reader = socket.socketpair()
+    allocated = 0
+    requests = 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        writer.sendall(chunk)
+        pending = len(chunk)
+        while pending:
+            if trace:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            lines = read(reader, buf)
+            if trace:
+                allocated += tracemalloc.get_traced_memory()[1] - base
+            for message in lines:
+                json.loads(str(message, "utf-8"))
+                pending -= len(message) + 1
+            requests += len(lines)
+            del lines
+    elapsed = time.perf_counter() - started
+    writer.close()
+    reader.close()
+    return requests, elapsed, allocated
+
+
+def run_recv(args):
+    """
+    Feed the same pipelined requests through the old and the new receive
+    path and decode them like handle_message does. Reports time per request,
+    and (in a second, traced run) the memory the read path allocates per
+    request on top of what it already holds, from tracemalloc's peak.
+    """
+    line = (json.dumps(random_command()) + "\n").encode()
+    chunk = line * args.pipeline
+    paths = [
+        ("recv + bytes slices", legacy_read, bytearray()),
+        ("recv_into + memoryview", recv_buffer_read, RecvBuffer(BufferPool())),
+    ]
+    print(f"{len(line)} byte requests, {args.pipeline} per round")
+    for name, read, buf in paths:
+        requests, elapsed, _ = feed_requests(read, buf, chunk, args.rounds, trace=False)
+        tracemalloc.start()
+        traced_requests, _, allocated = feed_requests(read, buf, chunk, args.rounds, trace=True)
+        tracemalloc.stop()
+        print(f"{name:24} {elapsed / requests * 1e6:6.2f} us/request  {allocated / traced_requests:7.1f} bytes allocated/request by the read path")
+    return 0
+
+
+def time_users(open_users, names):
+    """(seconds to open, bytes held once open, microseconds per lookup) of a users backend."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    users = open_users()
+    opened = time.perf_counter() - started
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    started = time.perf_counter()
+    for name in names:
+        name in users
+    lookup = (time.perf_counter() - started) / len(names)
+    return users, opened, held, lookup
+
+
+def run_users(args):
+    """
+    Startup time, memory and lookup cost of the users dict against the
+    SQLite user store, for a generated users file of --users accounts.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        users_file = os.path.join(directory, "users.txt")
+        with open(users_file, "w", encoding="utf-8") as file:
+            for i in range(args.users):
+                file.write(f"user{i:08d}\tpassword{i}\n")
+        store_path = os.path.join(directory, "users.db")
+        started = time.perf_counter()
+        build_store(users_file, store_path)
+        print(f"{args.users} users, store built in {time.perf_counter() - started:.2f} s")
+        known = [f"user{random.randrange(args.users):08d}" for _ in range(args.lookups)]
+        unknown = [f"nobody{i}" for i in range(args.lookups)]
+        for name, open_users in [("dict (load_users)", lambda: load_users(users_file)), ("user store", lambda: UserStore(store_path))]:
+            users, opened, held, known_lookup = time_users(open_users, known)
+            unknown_lookup = time_users(lambda: users, unknown)[3]
+            print(f"{name:18} open {opened * 1000:8.1f} ms  {held / 2 ** 20:7.1f} MiB  "
+                  f"known {known_lookup * 1e6:5.2f} us  unknown {unknown_lookup * 1e6:5.2f} us per lookup")
+            if isinstance(users, UserStore):
+                users.close()
+    return 0
+
+
+def run_lcm_many(args):
+    """
+    lcm of --sizes random pairs of --bits bit ints, one Python lcm() per pair
+    (the scalar path) against lcm_many. Checks that both agree.
+    """
+    if vector_utils.np is None:
+        print("NumPy is not installed; lcm_many uses the scalar path")
+    limit = 2 ** args.bits
+    for size in args.sizes:
+        xs = [random.randrange(-limit, limit) for _ in range(size)]
+        ys = [random.randrange(-limit, limit) for _ in range(size)]
+        started = time.perf_counter()
+        expected = [lcm(x, y) for x, y in zip(xs, ys)]
+        scalar = time.perf_counter() - started
+        started = time.perf_counter()
+        results = lcm_many(xs, ys)
+        vectorized = time.perf_counter() - started
+        assert results == expected
+        print(f"{size:8} pairs  scalar {scalar * 1000:9.2f} ms  lcm_many {vectorized * 1000:9.2f} ms  "
+              f"{scalar / vectorized:5.1f}x")
+    return 0
+
+
+def run_lcm_list(args):
+    """
+    LCM of --count random ints of each of --bits sizes, folded left to right
+    against lcm_list's balanced tree. Checks that both agree.
+    """
+    for bits in args.bits:
+        values = [random.getrandbits(bits) | 1 for _ in range(args.count)]
+        started = time.perf_counter()
+        expected = functools.reduce(lcm, values)
+        fold = time.perf_counter() - started
+        started = time.perf_counter()
+        result = lcm_list(values)
+        tree = time.perf_counter() - started
+        assert result == expected
+        print(f"{args.count} values of {bits:4} bits ({result.bit_length():8} bit LCM)  fold {fold * 1000:9.1f} ms  "
+              f"tree {tree * 1000:9.1f} ms  {fold / tree:5.1f}x")
+    return 0
+
+
+def run_caesar(args):
+    """caesar_chars (one character at a time) against the translate tables of caesar on --size bytes of text."""
+    text = "".join(random.choice(string.ascii_letters + " ") for _ in range(args.size))
+    timings = []
+    for name, function in [("caesar_chars", caesar_chars), ("caesar", caesar)]:
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            result = function(text, 3)
+        timings.append((time.perf_counter() - started) / args.rounds)
+        print(f"{name:14} {timings[-1] * 1000:8.2f} ms  {args.size / timings[-1] / 2 ** 20:8.1f} MiB/s")
+    assert caesar(text, 3) == caesar_chars(text, 3)
+    print(f"{timings[0] / timings[1]:.0f}x faster")
+    return 0
+
+
+def run_parentheses(args):
+    """
+    parentheses_depth_chars against parentheses_depth_array on balanced
+    strings of each of --sizes, to place PARENTHESES_ARRAY_MIN.
+    """
+    if vector_utils.np is None:
+        print("NumPy is not installed")
+        return 1
+    for size in args.sizes:
+        s = "()" * (size // 2)
+        rounds = max(1, args.chars // max(size, 1))
+        timings = []
+        for check in (parentheses_depth_chars, parentheses_depth_array):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                check(s)
+            timings.append((time.perf_counter() - started) / rounds)
+        print(f"{size:8} chars  loop {timings[0] * 1e6:10.1f} us  numpy {timings[1] * 1e6:10.1f} us  {timings[0] / timings[1]:6.1f}x")
+    return 0
+
+
+def run_parallel_caesar(args):
+    """
+    caesar of --sizes MB of text in one process against parallel_translate
+    (what the server runs above --parallel-caesar) on pools of --workers
+    processes. The parallel time includes copying the text into and out of
+    shared memory; the one-process time includes the ASCII encode like caesar.
+    """
+    start_tracker()
+    block = "".join(random.choice(string.ascii_letters + " ") for _ in range(1 << 20))
+    print(f"{os.cpu_count()} CPUs")
+    for size in args.sizes:
+        text = block * size
+        started = time.perf_counter()
+        expected = caesar(text, 3)
+        single = time.perf_counter() - started
+        print(f"{size:4} MB  1 process {single * 1000:8.1f} ms")
+        for workers in args.workers:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(abs, range(workers)))  # Start the processes before timing
+                started = time.perf_counter()
+                future = parallel_translate(pool, workers, text.encode("ascii"), CAESAR_TABLES[3], CAESAR_ALPHABET,
+                                            lambda result: str(result, "ascii"))
+                result = future.result()
+                elapsed = time.perf_counter() - started
+            assert result == expected
+            print(f"{size:4} MB  {workers} workers {elapsed * 1000:8.1f} ms  {single / elapsed:5.2f}x")
+    return 0
+
+
+def run_cache(args):
+    """
+    handle_message without and with the result cache on --count commands
+    drawn from --distinct random ones, for each of --sizes of caesar text
+    (the other commands are small lcm and parentheses ones like the stress
+    test sends).
+    """
+    SERVER_OPTIONS["inline_cost"] = SERVER_OPTIONS["max_cost"]  # Time the handlers, not a pool
+    client = {"authenticated": 2, "username": "Alice"}
+    for size in args.sizes:
+        commands = []
+        for _ in range(args.distinct):
+            command = random_command()
+            if command["type"] == "caesar":
+                command["text"] = "".join(random.choice(string.ascii_letters + " ") for _ in range(size))
+            commands.append(json.dumps(command).encode("utf-8"))
+        messages = [random.choice(commands) for _ in range(args.count)]
+        timings = []
+        for cache in (None, make_result_cache()):
+            started = time.perf_counter()
+            for message in messages:
+                handle_message(message, client, {}, None, None, cache)
+            timings.append((time.perf_counter() - started) / args.count)
+        print(f"caesar of {size:7} chars  no cache {timings[0] * 1e6:8.2f} us  "
+              f"cache {timings[1] * 1e6:8.2f} us  {timings[0] / timings[1]:5.1f}x")
+    return 0
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'Server hostname (default: {DEFAULT_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Server port (default: {DEFAULT_PORT})')
+    parser.add_argument('--username', default='Alice', help='Username for authentication')
+    parser.add_argument('--password', default='BetT3RpAas', help='Password for authentication')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the client-server program')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    load = subparsers.add_parser('load', help='Throughput and latency against a running server')
+    add_server_arguments(load)
+    load.add_argument('--clients', type=int, default=10, help='Number of concurrent clients')
+    load.add_argument('--duration', type=float, default=5.0, help='Seconds to run')
+    load.set_defaults(func=run_load)
+
+    logins = subparsers.add_parser('logins', help='Command latency during a login storm against a running server')
+    add_server_arguments(logins)
+    logins.add_argument('--logins', type=int, default=400, help='Total logins')
+    logins.add_argument('--clients', type=int, default=50, help='Concurrent logging in clients')
+    logins.add_argument('--warmup', type=float, default=2.0, help='Seconds of commands before the storm starts')
+    logins.set_defaults(func=run_logins)
+
+    batch = subparsers.add_parser('batch', help='Single messages against batch messages on a running server')
+    add_server_arguments(batch)
+    batch.add_argument('--count', type=int, default=20000, help='Total lcm commands')
+    batch.add_argument('--size', type=int, default=1000, help='Commands per batch message')
+    batch.set_defaults(func=run_batch)
+
+    recv = subparsers.add_parser('recv', help='Copies and allocations of the receive path (no server needed)')
+    recv.add_argument('--pipeline', type=int, default=50, help='Requests sent back to back per round')
+    recv.add_argument('--rounds', type=int, default=200, help='Number of rounds')
+    recv.set_defaults(func=run_recv)
+
+    users = subparsers.add_parser('users', help='Users dict against the SQLite user store (no server needed)')
+    users.add_argument('--users', type=int, default=1000000, help='Number of generated users')
+    users.add_argument('--lookups', type=int, default=20000, help='Lookups of known and of unknown usernames')
+    users.set_defaults(func=run_users)
+
+    lcm = subparsers.add_parser('lcm_many', help='Scalar lcm against the vectorized lcm_many (no server needed)')
+    lcm.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='Numbers of pairs')
+    lcm.add_argument('--bits', type=int, default=31, help='Bits per int; above 31 some lcms overflow int64 and take the exact path')
+    lcm.set_defaults(func=run_lcm_many)
+
+    lcm_values = subparsers.add_parser('lcm_list', help='Left fold against the balanced tree of lcm_list (no server needed)')
+    lcm_values.add_argument('--count', type=int, default=10000, help='Values per list')
+    lcm_values.add_argument('--bits', type=int, nargs='+', default=[16, 64, 256], help='Bits per value')
+    lcm_values.set_defaults(func=run_lcm_list)
+
+    caesar_text = subparsers.add_parser('caesar', help='Character loop against translate tables for caesar (no server needed)')
+    caesar_text.add_argument('--size', type=int, default=1 << 20, help='Characters of text')
+    caesar_text.add_argument('--rounds', type=int, default=3, help='Runs of each implementation')
+    caesar_text.set_defaults(func=run_caesar)
+
+    parentheses = subparsers.add_parser('parentheses', help='Character loop against the NumPy parentheses check (no server needed)')
+    parentheses.add_argument('--sizes', type=int, nargs='+', default=[16, 64, 128, 256, 1024, 65536, 1 << 20], help='String lengths')
+    parentheses.add_argument('--chars', type=int, default=1 << 21, help='Characters checked per size, split into rounds')
+    parentheses.set_defaults(func=run_parentheses)
+
+    parallel = subparsers.add_parser('parallel_caesar', help='caesar in one process against a shared memory process pool (no server needed)')
+    parallel.add_argument('--sizes', type=int, nargs='+', default=[10, 100], help='Text sizes in MB')
+    parallel.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Pool sizes')
+    parallel.set_defaults(func=run_parallel_caesar)
+
+    cache = subparsers.add_parser('cache', help='handle_message without and with the result cache (no server needed)')
+    cache.add_argument('--sizes', type=int, nargs='+', default=[60, 10000, 1000000], help='Characters of caesar text')
+    cache.add_argument('--distinct', type=int, default=100, help='Distinct commands the workload repeats')
+    cache.add_argument('--count', type=int, default=3000, help='Commands handled')
+    cache.set_defaults(func=run_cache)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+import collections, itertools, os, socket
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# Tells the kernel more data follows right away, so it holds back a
+# partially filled segment instead of sending it (Linux only).
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
+NEWLINE = b"\n"
+
+# Size of the pooled receive buffers; lines longer than this get a bigger, unpooled buffer
+RECV_BUFFER_SIZE = 16384
+
+
+class SendQueue:
+    """
+    Outbound data of one connection.
+
+    Responses are queued whole and in order; flush() hands as many of them as
+    possible to the kernel with a single sendmsg (writev) call. A partially
+    sent response stays at the head of the queue and only the offset into it
+    moves forward, so the unsent rest is never copied.
+    """
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.offset = 0  # Bytes of chunks[0] already sent
+        self.size = 0    # Bytes still to send
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def append_line(self, data):
+        """Queue data followed by a newline, without concatenating them."""
+        self.append(data)
+        self.append(NEWLINE)
+
+    def flush(self, sock):
+        """
+        Send as much queued data as sock accepts right now.
+        Returns the number of bytes sent; raises OSError if the socket failed.
+        """
+        if not self.size:
+            return 0
+        batch = list(itertools.islice(self.chunks, IOV_MAX))
+        if self.offset:
+            batch[0] = memoryview(batch[0])[self.offset:]
+        flags = MSG_MORE if len(batch) < len(self.chunks) else 0
+        try:
+            if hasattr(sock, "sendmsg"):
+                sent = sock.sendmsg(batch, (), flags)
+            else:
+                sent = sock.send(b"".join(batch))
+        except (BlockingIOError, InterruptedError):
+            return 0
+        self.consume(sent)
+        return sent
+
+    def consume(self, sent):
+        """Drop sent bytes from the head of the queue."""
+        self.size -= sent
+        sent += self.offset
+        chunks = self.chunks
+        while chunks and sent >= len(chunks[0]):
+            sent -= len(chunks.popleft())
+        self.offset = sent
+
+
+class BufferPool:
+    """
+    Free list of equally sized bytearrays shared by all connections of one
+    event loop. Connections take a buffer only while they hold unprocessed
+    input, so idle connections cost no buffer memory at all.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE, max_free=1024):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+
+    def acquire(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def release(self, buf):
+        if len(buf) == self.size and len(self.free) < self.max_free:
+            self.free.append(buf)
+
+
+class RecvBuffer:
+    """
+    Input buffer of one connection, filled in place with recv_into.
+
+    Unprocessed data lives in buf[start:end]. Lines are handed out as
+    memoryviews into buf, so they reach the JSON decoder without being
+    copied into bytes objects first. A line is only valid until the next
+    call to writable(), which may move the unprocessed data to the front of
+    the buffer to make room.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.buf = None
+        self.view = None
+        self.start = 0
+        self.end = 0
+        self.scanned = 0  # buf[start:scanned] is known to hold no newline
+
+    def __len__(self):
+        return self.end - self.start
+
+    def writable(self):
+        """A memoryview of the free space at the end of the buffer, for recv_into."""
+        if self.buf is None:
+            self.buf = self.pool.acquire()
+            self.view = memoryview(self.buf)
+        elif self.end == len(self.buf):
+            size = self.end - self.start
+            if self.start:
+                # Move the partial line to the front (overlapping copy is safe on memoryviews)
+                self.view[:size] = self.view[self.start:self.end]
+            else:
+                # The partial line fills the whole buffer: switch to a bigger, unpooled one
+                bigger = bytearray(2 * len(self.buf))
+                bigger[:size] = self.view[:size]
+                self.view.release()
+                self.pool.release(self.buf)
+                self.buf, self.view = bigger, memoryview(bigger)
+            self.scanned -= self.start
+            self.start, self.end = 0, size
+        return self.view[self.end:]
+
+    def written(self, count):
+        """Account for count bytes written into the view returned by writable()."""
+        self.end += count
+
+    def recv_from(self, sock):
+        """recv_into the buffer. Returns the byte count, 0 when the peer closed."""
+        count = sock.recv_into(self.writable())
+        self.written(count)
+        return count
+
+    def next_line(self):
+        """The next complete line (without its newline) as a memoryview, or None."""
+        if self.buf is None:
+            return None
+        index = self.buf.find(b"\n", self.scanned, self.end)
+        if index == -1:
+            self.scanned = self.end
+            return None
+        line = self.view[self.start:index]
+        self.start = self.scanned = index + 1
+        return line
+
+    def trim(self):
+        """Give the buffer back to the pool once everything in it was processed."""
+        if self.buf is not None and self.start == self.end:
+            self.release()
+
+    def release(self):
+        if self.buf is not None:
+            self.view.release()
+            self.pool.release(self.buf)
+        self.buf = self.view = None
+        self.start = self.end = self.scanned = 0
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+import collections
+
+# Rough bytes a cache entry holds besides its response and key contents:
+# the key tuple, the OrderedDict node and the bytes object header
+ENTRY_OVERHEAD = 200
+
+
+class ResultCache:
+    """
+    Least recently used map from normalized commands to their encoded
+    responses, bounded by the bytes it holds rather than by its number of
+    entries, so a few huge responses cannot crowd out memory any more than
+    many small ones. Hits, misses and evictions are counted in stats (a
+    Counter) as cache_hits, cache_misses and cache_evictions.
+    """
+
+    def __init__(self, max_bytes, stats):
+        self.max_bytes = max_bytes
+        self.stats = stats
+        self.size = 0
+        self.entries = collections.OrderedDict()  # key: (response, size), least recently used first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["cache_misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["cache_hits"] += 1
+        return entry[0]
+
+    def put(self, key, response, key_size=0):
+        """
+        Store response under key; key_size is what the key's contents take
+        (the text of a caesar, say). A response bigger than the whole cache
+        is not stored.
+        """
+        size = len(response) + key_size + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.entries[key] = (response, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+            self.stats["cache_evictions"] += 1
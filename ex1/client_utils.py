@@ -94,6 +94,10 @@ def handle_user_input(line, client_state):
         if line[0] == "Password:":
             if length != 2:
                 return retry_answer
+            if client_state.get("combined_login"):
+                # The username was kept back; both go to the server in one message
+                print_strings(general_utils.verbose, "CLIENT: Sending username and password")
+                return (json.dumps({"type": "login", "username": client_state["username"], "password": line[1]}), 0)
             print_strings(general_utils.verbose, "CLIENT: Sending password")
             result = (json.dumps({"type": "login_password", "password": line[1]}), 0)
             return result
@@ -105,6 +109,13 @@ def handle_user_input(line, client_state):
     if line[0] == "User:":
         if length != 2:
             return retry_answer
+        if client_state.get("combined_login") and client_state["auth_state"] == 0:
+            # The server accepts a combined "login" message: ask for the password
+            # right away and save the round trip of sending the username alone
+            client_state["auth_state"] = 1
+            client_state["username"] = line[1]
+            print_strings(general_utils.verbose, "CLIENT: Please use the format 'Password: yourpassword'")
+            return handle_user_input(input().strip().split(), client_state)
         print_strings(general_utils.verbose, f"CLIENT: Sending username: {line[1]}")
         return (json.dumps({"type": "login_username", "username": line[1]}), 0)
 
@@ -122,8 +133,11 @@ def handle_user_input(line, client_state):
         return (json.dumps({"type": "parentheses", "string": line[1]}), 0)
 
     elif line[0] == "lcm:":
-        if length != 3:
+        if length < 3:
             return retry_answer
+        if length > 3:
+            print_strings(general_utils.verbose, f"CLIENT: Sending LCM request for {length - 1} values")
+            return (json.dumps({"type": "lcm", "values": line[1:]}), 0)
         print_strings(general_utils.verbose, f"CLIENT: Sending LCM request for values: {line[1]} and {line[2]}")
         return (json.dumps({"type": "lcm", "x": line[1], "y": line[2]}), 0)
 
@@ -171,7 +185,7 @@ def handle_server_input(line, client_state):
         if client_state["auth_state"] == 2:
             print_strings(general_utils.verbose, 
                 "CLIENT: You can use the following commands:",
-                "  lcm: x y - Calculate least common multiple",
+                "  lcm: x y [z ...] - Calculate least common multiple",
                 "  parentheses: string - Check if parentheses are balanced",
                 "  caesar: text shift - Apply Caesar cipher",
                 "  quit - Exit the client"
@@ -187,7 +201,12 @@ def handle_server_input(line, client_state):
             print("the ciphertext is: ", data.get("result"), sep='')
     elif cmd_type in MESSAGE_SET:
         print("\n" + data.get("message"))
-        if cmd_type == "continue":
+        if cmd_type == "greeting":
+            client_state["combined_login"] = "login" in data.get("features", [])
+        elif cmd_type == "login_failure" and client_state.get("combined_login"):
+            # A failed combined login leaves the server waiting for a new login
+            client_state["auth_state"] = 0
+        elif cmd_type == "continue":
             client_state["auth_state"] = 1
             client_state["username"] = "username_sent"
             print_strings(general_utils.verbose, 
@@ -203,7 +222,7 @@ def handle_server_input(line, client_state):
             print_strings(general_utils.verbose, 
                 "CLIENT: Successfully logged in!",
                 "CLIENT: You can now use the following commands:",
-                "  lcm: x y - Calculate least common multiple",
+                "  lcm: x y [z ...] - Calculate least common multiple",
                 "  parentheses: string - Check if parentheses are balanced",
                 "  caesar: text shift - Apply Caesar cipher",
                 "  quit - Exit the client"
@@ -1,111 +1,376 @@
 #!/usr/bin/python3
 
-import socket, select, json
+import os, signal, socket, selectors, sys, time
 import general_utils
-from server_utils import load_users, parse_args, delete_client, handle_message
+import server_async
+from worker_utils import supervise
+from offload_utils import is_pending
+from buffer_utils import SendQueue, BufferPool, RecvBuffer
+from timer_utils import TimerWheel
+from reload_utils import UsersReloader
+from user_store import UserStore, is_store
+from server_utils import load_users, parse_args, delete_client, handle_message, complete_offloaded, client_deadline, make_offloader, make_rate_limiters, make_result_cache, response_bytes, format_stats, SELECTORS, SERVER_OPTIONS, ASYNC_ENGINES, make_greeting_line, SERVER_FULL_LINE, MESSAGE_TOO_LONG
 from general_utils import print_strings
 
 DEFAULT_PORT = 1337
 MESSAGE_MAX_SIZE = 4096
 
+
+def set_interest(selector, sock, client, send_queue, recv_buffer):
+    """
+    Register sock for write events only while its send queue holds data, and
+    for read events unless the client has to be slowed down: while it is
+    being closed, while its unsent output is above high_water (until it
+    drains to a quarter of that), or while it has max_buffered bytes of
+    unprocessed input waiting behind a pooled job.
+    The selector is only touched when the interest actually changes.
+    """
+    if len(send_queue) > SERVER_OPTIONS["high_water"]:
+        client["output_paused"] = True
+    elif len(send_queue) <= SERVER_OPTIONS["high_water"] // 4:
+        client["output_paused"] = False
+
+    events = 0
+    input_paused = client.get("pending") is not None and len(recv_buffer) >= SERVER_OPTIONS["max_buffered"]
+    if not (client.get("closing") or client["output_paused"] or input_paused):
+        events |= selectors.EVENT_READ
+    if send_queue:
+        events |= selectors.EVENT_WRITE
+
+    key = selector.get_map().get(sock)
+    current = key.events if key is not None else 0
+    if events == current:
+        return
+    if not events:
+        selector.unregister(sock)
+    elif not current:
+        selector.register(sock, events)
+    else:
+        selector.modify(sock, events)
+
+
 def main():
     users_file, port = parse_args()
-    
-    users = load_users(users_file) # Dict of {username: password}
-    print_strings(general_utils.verbose, 
-        f"SERVER: Loaded {len(users)} users from file: {users_file}",
-        f"SERVER: Listening on port {port}..."
-    )
 
+    if is_store(users_file):
+        # Opened by each worker in run_engine: an SQLite connection must not cross a fork
+        users = None
+        print_strings(general_utils.verbose, f"SERVER: Using user store: {users_file}")
+    else:
+        users = load_users(users_file) # Dict of {username: password}
+        print_strings(general_utils.verbose, f"SERVER: Loaded {len(users)} users from file: {users_file}")
+    print_strings(general_utils.verbose, f"SERVER: Listening on port {port}...")
+
+    workers = SERVER_OPTIONS["workers"]
+    if workers == 1:
+        run_engine(make_server_socket(port), users, users_file)
+        return
+
+    # Without SO_REUSEPORT the workers share the socket they inherit;
+    # with it every worker binds its own and the kernel balances between them.
+    shared_socket = None if SERVER_OPTIONS["reuseport"] else make_server_socket(port)
+
+    def worker_main(index):
+        server_socket = shared_socket or make_server_socket(port, reuseport=True)
+        print_strings(general_utils.verbose, f"SERVER: Worker {index} running in process {os.getpid()}")
+        run_engine(server_socket, users, users_file)
+
+    supervise(workers, worker_main)
+
+
+def make_server_socket(port, reuseport=False):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.setblocking(False)
     server_socket.bind(("", port))
-    server_socket.listen(5)
+    server_socket.listen(SERVER_OPTIONS["backlog"])
+    return server_socket
+
+
+def run_engine(server_socket, users, users_file):
+    # Exit through SystemExit on SIGTERM so that the engines can shut their pools down
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print(format_stats(), flush=True))
+    if users is None:
+        users = UserStore(users_file)
+    reloader = UsersReloader(users_file, users, SERVER_OPTIONS["reload_interval"])
+    try:
+        if SERVER_OPTIONS["engine"] in ASYNC_ENGINES:
+            server_async.serve(server_socket, users, reloader)
+        else:
+            serve(server_socket, users, reloader)
+    finally:
+        reloader.shutdown()
+
+
+def serve(server_socket, users, reloader):
+    """
+    Run the selectors based event loop on an already listening socket.
+    reloader keeps users in sync with the users file.
+    """
+    selector = SELECTORS[SERVER_OPTIONS["engine"]]()
+    selector.register(server_socket, selectors.EVENT_READ)
+    print_strings(general_utils.verbose, f"SERVER: Using {type(selector).__name__} event loop")
+
+    # Expensive commands run here; finished jobs wake the loop through wakeup_socket
+    offloader = make_offloader()
+    selector.register(offloader.wakeup_socket, selectors.EVENT_READ)
+
+    # SIGHUP reloads the users file; the wakeup socket makes select() return for it
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reloader.request())
+        offloader.wake_on_signals()
 
-    sockets_list = [server_socket]
     clients = {}
     client_send_buffers = {}
     clients_recv_buffers = {}
+    buffer_pool = BufferPool()
+    limiters = make_rate_limiters()
+    cache = make_result_cache()
+    greeting_line = make_greeting_line()
+
+    # Sockets that got new responses during this loop iteration; flushed
+    # once at the end of it, so pipelined responses share one sendmsg call.
+    unflushed = set()
+
+    # Handshake, idle and partial-line timeouts; keyed by (socket, deadline)
+    wheel = TimerWheel(time.monotonic())
+
+    def queue_response(sock, response):
+        # Responses are queued behind any unsent ones, so pipelined commands
+        # get all their responses, in order.
+        client_send_buffers[sock].append_line(response_bytes(response))
+        unflushed.add(sock)
 
-    while True:
-        # Writable sockets are those with data to send
-        writable_set = [s for s in sockets_list if client_send_buffers.get(s) and len(client_send_buffers[s]) > 0]
-        readable, writeable, exceptional = select.select(sockets_list, writable_set, sockets_list)
-
-        for notified_socket in readable:
-            if notified_socket == server_socket:
-                client_socket, _ = server_socket.accept()
-                client_socket.setblocking(False)
-                sockets_list.append(client_socket)
-                clients[client_socket] = {"authenticated": 0,  "username": None}# 0 for no_auth, 1 for only_username, 2 for fully_auth
-                client_send_buffers[client_socket] = bytearray()
-                clients_recv_buffers[client_socket] = bytearray()
-                greeting = json.dumps({"type": "greeting", "message": "Welcome! Please log in."}) + "\n"
-                client_send_buffers[client_socket].extend(greeting.encode("utf-8"))
-                client_address = client_socket.getpeername()
-                clients[client_socket]["address"] = client_address
-                print_strings(general_utils.verbose, f"SERVER: New connection accepted from {client_address}")
+    def touch(sock):
+        """
+        Make sure a timer is armed for the client's current deadline. Only an
+        earlier deadline adds a timer; a later one is picked up when the
+        armed timer fires and finds the client was active since.
+        """
+        client = clients[sock]
+        deadline = client_deadline(client)
+        if deadline is not None and (client.get("timer_at") is None or deadline < client["timer_at"]):
+            wheel.schedule(deadline, (sock, deadline))
+            client["timer_at"] = deadline
+
+    def expire_timers(now):
+        for sock, deadline in wheel.expire(now):
+            client = clients.get(sock)
+            if client is None or client.get("timer_at") != deadline:
+                continue  # Client is gone, or an earlier timer replaced this one
+            client["timer_at"] = None
+            current = client_deadline(client)
+            if current is None or current > now:
+                touch(sock)  # Active since the timer was armed
+                continue
+            if client["authenticated"] < 2:
+                reason = "did not log in in time"
+            elif client.get("partial_since") is not None and client["partial_since"] + SERVER_OPTIONS["line_timeout"] <= now:
+                reason = "did not finish its message in time"
+            else:
+                reason = "was idle for too long"
+            print_strings(general_utils.verbose, f"SERVER: Disconnecting client {client.get('username') or client['address']}: {reason}")
+            delete_client(sock, selector, clients, client_send_buffers, clients_recv_buffers)
+
+    def sync_users():
+        """Apply a finished reload of the users file, or start one if it is due."""
+        if reloader.future is not None:
+            if reloader.future.done():
+                drop_sessions(reloader.apply())
+        elif reloader.check(time.monotonic()) is not None:
+            reloader.future.add_done_callback(lambda future: offloader.wake())
+
+    def drop_sessions(changed):
+        """After users changed, disconnect the clients of removed users if --removed-users disconnect asks for it."""
+        if not changed or SERVER_OPTIONS["removed_users"] != "disconnect":
+            return
+        for sock, client in list(clients.items()):
+            if client["username"] is not None and client["username"] not in users:
+                print_strings(general_utils.verbose, f"SERVER: Disconnecting client {client['username']}: user was removed")
+                delete_client(sock, selector, clients, client_send_buffers, clients_recv_buffers)
+
+    def process_lines(sock):
+        """
+        Process as many complete newline-terminated messages as sock has buffered.
+        Stops early while a command of this client runs on the pool, so the
+        responses keep the order of the requests.
+        """
+        buf = clients_recv_buffers[sock]
+        client = clients[sock]
+        while client.get("pending") is None:
+            # One full message (without the trailing newline), as a view into the receive buffer
+            line = buf.next_line()
+            if line is None:
+                if len(buf) > SERVER_OPTIONS["max_line"]:
+                    # A partial line is already longer than any message may be
+                    reject_oversized(sock)
+                    return
+                break  # no full message yet; wait for more data
+            if len(line) > SERVER_OPTIONS["max_line"]:
+                reject_oversized(sock)
+                return
+
+            if not line:
+                continue  # skip empty lines or keepalives
+
+            # Process the message
+            client["last_active"] = time.monotonic()
+            client["partial_since"] = None
+            response = handle_message(line, client, users, offloader, limiters, cache)
+            user_id = client.get('username') or client["address"]
+            print_strings(general_utils.verbose, f"SERVER: Processed message from {user_id}")
+
+            # Check if client should be disconnected for unauthorized command
+            if response == "DISCONNECT":
+                print_strings(general_utils.verbose, f"SERVER: Disconnecting client {user_id} for unauthorized command attempt before authentication")
+                delete_client(sock, selector, clients, client_send_buffers, clients_recv_buffers)
+                return
+            elif is_pending(response):
+                client["pending"] = response
+                offloader.watch(response, sock)
+            elif response is not None:
+                queue_response(sock, response)
+
+        buf.trim()
+        if not buf or client.get("pending") is not None:
+            client["partial_since"] = None
+        elif client.get("partial_since") is None:
+            client["partial_since"] = time.monotonic()  # A message has started to arrive
+        touch(sock)
+
+    def reject_oversized(sock):
+        """Answer an over-long message with an error, then close once that is sent."""
+        client = clients[sock]
+        print_strings(general_utils.verbose, f"SERVER: Message from {client.get('username') or client['address']} exceeds {SERVER_OPTIONS['max_line']} bytes, disconnecting")
+        if client.get("pending") is not None:
+            client["pending"].cancel()
+            client["pending"] = None
+        client["closing"] = True
+        clients_recv_buffers[sock].release()
+        queue_response(sock, MESSAGE_TOO_LONG)
+
+    def accept_clients():
+        """
+        Accept the connections waiting in the backlog, up to accept_budget of
+        them, so a burst of clients does not trickle in one per loop iteration
+        while the clients already connected still get served in between.
+        """
+        for _ in range(SERVER_OPTIONS["accept_budget"]):
+            try:
+                client_socket, client_address = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return  # Backlog drained (or another worker took the connection)
+            except OSError as e:
+                # E.g. out of file descriptors; the rest stays queued in the backlog
+                print_strings(general_utils.verbose, f"SERVER: Failed to accept a connection: {e}")
+                return
+            if len(clients) >= SERVER_OPTIONS["max_connections"]:
+                turn_away(client_socket, client_address)
             else:
-                message = notified_socket.recv(MESSAGE_MAX_SIZE)
-                if not message:
-                    print_strings(general_utils.verbose, f"SERVER: Client disconnected: {clients[notified_socket].get('address', 'unknown')}")
-                    delete_client(notified_socket, sockets_list, clients, client_send_buffers, clients_recv_buffers)
-                    if(notified_socket in writeable):
-                        writeable.remove(notified_socket)
-                    continue
-
-                buf = clients_recv_buffers[notified_socket]
-                buf.extend(message)
-                if b"\n" not in clients_recv_buffers[notified_socket]:
-                    # Handle case where message is too long (e.g. we passed some size - throw error?)
-                    continue
-
-                # Process as many complete newline-terminated messages as we have.
-                while True:
-                    nl_index = buf.find(b"\n")
-                    if nl_index == -1:
-                        break  # no full message yet; wait for more data
-
-                    # Extract one full message (without the trailing newline)
-                    line = bytes(buf[:nl_index])
-                    # Remove the processed message (+ the newline) from the buffer
-                    del buf[:nl_index + 1]
-
-                    if not line:
-                        continue  # skip empty lines or keepalives
-
-                    # Process the message
-                    response = handle_message(line, clients[notified_socket], users)
-                    user_id = clients[notified_socket].get('username') or notified_socket.getpeername()
-                    print_strings(general_utils.verbose, f"SERVER: Processed message from {user_id}")
-                    
-                    # Check if client should be disconnected for unauthorized command
-                    if response == "DISCONNECT":
-                        print_strings(general_utils.verbose, f"SERVER: Disconnecting client {user_id} for unauthorized command attempt before authentication")
-                        delete_client(notified_socket, sockets_list, clients, client_send_buffers, clients_recv_buffers)
-                        break
-                    elif response is not None:
-                        # Clear previous data from buffer before adding new response
-                        # This prevents old responses from being shown after errors
-                        client_send_buffers[notified_socket] = bytearray()
-                        client_send_buffers[notified_socket].extend(response.encode("utf-8") + b"\n")
-
-
-        for notified_socket in writeable:
-            if notified_socket in clients and len(client_send_buffers[notified_socket]) > 0:
-                try:
-                    sent = notified_socket.send(client_send_buffers[notified_socket])
-                    client_send_buffers[notified_socket] = client_send_buffers[notified_socket][sent:]
-                    user_id = clients[notified_socket].get('username') or notified_socket.getpeername()
-                    print_strings(general_utils.verbose, f"SERVER: Sent {sent} bytes to {user_id}")
-                except Exception as e:
-                    print_strings(general_utils.verbose, f"SERVER: Error sending data to client: {e}")
-                    delete_client(notified_socket, sockets_list, clients, client_send_buffers, clients_recv_buffers)
-        
-        for notified_socket in exceptional:
-            print_strings(general_utils.verbose, f"SERVER: Socket exception for client: {clients[notified_socket].get('address', 'unknown')}")
-            delete_client(notified_socket, sockets_list, clients, client_send_buffers, clients_recv_buffers)
+                accept_client(client_socket, client_address)
+
+    def turn_away(client_socket, client_address):
+        print_strings(general_utils.verbose, f"SERVER: Too many connections, turning away {client_address}")
+        try:
+            client_socket.send(SERVER_FULL_LINE, socket.MSG_DONTWAIT)
+        except OSError:
+            pass  # Best effort; it fits in any empty socket buffer
+        client_socket.close()
+
+    def accept_client(client_socket, client_address):
+        client_socket.setblocking(False)
+        now = time.monotonic()
+        clients[client_socket] = {"authenticated": 0,  "username": None, "output_paused": False, "connected_at": now, "last_active": now}# 0 for no_auth, 1 for only_username, 2 for fully_auth
+        client_send_buffers[client_socket] = SendQueue()
+        clients_recv_buffers[client_socket] = RecvBuffer(buffer_pool)
+        clients[client_socket]["address"] = client_address
+        selector.register(client_socket, selectors.EVENT_READ)
+        client_send_buffers[client_socket].append(greeting_line)
+        unflushed.add(client_socket)
+        touch(client_socket)
+        print_strings(general_utils.verbose, f"SERVER: New connection accepted from {client_address}")
+
+    def deliver_completions():
+        for sock, future in offloader.completed():
+            client = clients.get(sock)
+            # The client may have disconnected while its job was running
+            if client is None or client.get("pending") is not future:
+                continue
+            client["pending"] = None
+            queue_response(sock, complete_offloaded(client, future))
+            process_lines(sock)
+
+    def read_client(sock):
+        if clients[sock].get("closing"):
+            return  # Still flushing its last response; input is ignored
+        try:
+            # Straight into the connection's pooled buffer, no intermediate bytes object
+            received = clients_recv_buffers[sock].recv_from(sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print_strings(general_utils.verbose, f"SERVER: Socket exception for client {clients[sock].get('address', 'unknown')}: {e}")
+            received = 0
+        if not received:
+            print_strings(general_utils.verbose, f"SERVER: Client disconnected: {clients[sock].get('address', 'unknown')}")
+            delete_client(sock, selector, clients, client_send_buffers, clients_recv_buffers)
+            return
+        process_lines(sock)
+        if sock in clients:
+            set_interest(selector, sock, clients[sock], client_send_buffers[sock], clients_recv_buffers[sock])
+
+    def write_client(sock):
+        try:
+            sent = client_send_buffers[sock].flush(sock)
+            user_id = clients[sock].get('username') or clients[sock]["address"]
+            print_strings(general_utils.verbose, f"SERVER: Sent {sent} bytes to {user_id}")
+        except Exception as e:
+            print_strings(general_utils.verbose, f"SERVER: Error sending data to client: {e}")
+            delete_client(sock, selector, clients, client_send_buffers, clients_recv_buffers)
+            return
+        if clients[sock].get("closing") and not client_send_buffers[sock]:
+            delete_client(sock, selector, clients, client_send_buffers, clients_recv_buffers)
+            return
+        set_interest(selector, sock, clients[sock], client_send_buffers[sock], clients_recv_buffers[sock])
+
+    try:
+        while True:
+            # Only sockets with pending output are registered for EVENT_WRITE,
+            # so this returns just the sockets that actually need attention,
+            # and the timeout makes it return when the next timer or users
+            # file check is due.
+            now = time.monotonic()
+            timeouts = [timeout for timeout in (wheel.timeout(now), reloader.timeout(now)) if timeout is not None]
+            events = selector.select(min(timeouts) if timeouts else None)
+
+            for key, mask in events:
+                notified_socket = key.fileobj
+                if notified_socket is server_socket:
+                    accept_clients()
+                elif notified_socket is offloader.wakeup_socket:
+                    deliver_completions()
+                else:
+                    if mask & selectors.EVENT_READ and notified_socket in clients:
+                        read_client(notified_socket)
+                    if mask & selectors.EVENT_WRITE and notified_socket in clients:
+                        unflushed.add(notified_socket)
+
+            if wheel:
+                expire_timers(time.monotonic())
+            sync_users()
+
+            # One sendmsg per socket per iteration; whatever the kernel does
+            # not take now is sent once the socket becomes writable.
+            while unflushed:
+                sock = unflushed.pop()
+                if sock in clients:
+                    write_client(sock)
+    finally:
+        offloader.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+import collections, json, multiprocessing, os, signal, socket, threading
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
+import general_utils
+from general_utils import print_strings
+from parallel_utils import start_tracker
+
+INTERNAL_ERROR = json.dumps({"type": "error", "message": "Internal error while processing the request."})
+BUSY_ERROR = json.dumps({"type": "error", "message": "Server is busy. Please try again later."})
+
+# Pool processes start from a fresh forkserver process rather than as forks
+# of the server, which would hold every client socket open at that moment
+# and keep close() from ever reaching those clients
+PROCESS_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def make_process_pool(size, initializer=None, initargs=()):
+    """A ProcessPoolExecutor of size processes that do not inherit the server's sockets."""
+    return ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context(PROCESS_START_METHOD),
+                               initializer=initializer, initargs=initargs)
+
+
+class Offloader:
+    """
+    Bounded worker pool for requests that are too expensive to run on the
+    event loop thread.
+
+    The event loop submits work with submit() and gets a Future back. The
+    select loop hands the Future to watch(); when it finishes, the Future is
+    queued on completions and one byte is written to wakeup_socket, which the
+    loop has registered for reading, so finished work is picked up on the
+    loop thread by completed(). The asyncio engine waits on the Future with
+    asyncio.wrap_future instead and calls release() itself.
+
+    Process pools run initializer(*initargs) in every process they start.
+    """
+
+    def __init__(self, kind="thread", size=0, max_pending=0, parallel=False, initializer=None, initargs=()):
+        size = size or os.cpu_count() or 1
+        if parallel:
+            start_tracker()  # Before the first fork, see parallel_utils
+        self.kind, self.initializer, self.initargs = kind, initializer, initargs
+        self.executor = self.make_executor(size)
+        # Process pool that data-parallel jobs are split across (see submit_parallel), if enabled
+        self.parallel = None
+        if parallel:
+            self.parallel = self.executor if kind == "process" else make_process_pool(size)
+        self.size = size
+        self.max_pending = max_pending or 64 * size
+        self.pending = 0
+        # Jobs that submit_shared callers can still join, key: (job, set of their Futures);
+        # entries are removed by the pool thread that finishes the job, hence the lock
+        self.in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.completions = collections.deque()  # (key, future); appended from pool threads
+        self.wakeup_socket, self._wakeup_writer = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+    def make_executor(self, size):
+        if self.kind == "process":
+            return make_process_pool(size, self.initializer, self.initargs)
+        return ThreadPoolExecutor(max_workers=size, thread_name_prefix="offload")
+
+    def submit(self, fn, *args):
+        """
+        Run fn(*args) in the pool. Returns a Future, or None if max_pending
+        jobs are already queued or running, or the pool cannot take jobs.
+        """
+        if not self.reserve():
+            return None
+        try:
+            return self.executor.submit(fn, *args)
+        except BrokenExecutor:
+            # A pool process died (killed for memory, say): later jobs get a new pool
+            print_strings(general_utils.verbose, "SERVER: ERROR - Offload pool is broken, starting a new one")
+            self.replace_broken(self.executor)
+        except RuntimeError:
+            pass  # Shut down: the server is stopping
+        self.release()
+        return None
+
+    def submit_parallel(self, start, *args):
+        """
+        Like submit, for start(parallel, size, *args), which splits its work
+        into up to size jobs on the parallel process pool and returns a
+        Future for all of them. Counts as one pending job.
+        """
+        if not self.reserve():
+            return None
+        try:
+            return start(self.parallel, self.size, *args)
+        except BrokenExecutor:
+            print_strings(general_utils.verbose, "SERVER: ERROR - Parallel pool is broken, starting a new one")
+            self.replace_broken(self.parallel)
+        except RuntimeError:
+            pass  # Shut down: the server is stopping
+        self.release()
+        return None
+
+    def replace_broken(self, broken):
+        """Start a new pool in place of broken: the offload pool, the parallel pool, or both if they are one."""
+        if broken is self.executor:
+            self.executor = self.make_executor(self.size)
+        if broken is self.parallel:
+            self.parallel = self.executor if self.kind == "process" else make_process_pool(self.size)
+        broken.shutdown(wait=False)
+
+    def submit_shared(self, key, start):
+        """
+        Like start() (submit or submit_parallel with its arguments bound), but
+        callers with the same key share one job while it is in flight. Each
+        caller gets its own Future of the job's outcome, so that one of them
+        being cancelled (its client left) cancels the job only if it was the
+        last one waiting. Returns (future, shared), shared being True if an
+        in-flight job was joined, or (None, False) if the pool is full.
+        A joined job counts as one more pending job but is never refused.
+        Loop thread only.
+        """
+        with self._in_flight_lock:
+            entry = self.in_flight.get(key)
+            if entry is not None:
+                waiter = self._wait_for(key, entry)
+        if entry is not None:
+            self.pending += 1
+            return waiter, True
+        job = start()
+        if job is None:
+            return None, False
+        entry = (job, set())
+        waiter = self._wait_for(key, entry)
+        with self._in_flight_lock:
+            self.in_flight[key] = entry
+
+        def finished(job):
+            with self._in_flight_lock:
+                if self.in_flight.get(key) is entry:
+                    del self.in_flight[key]
+                waiters = list(entry[1])
+            for waiter in waiters:
+                copy_outcome(job, waiter)
+
+        job.add_done_callback(finished)
+        return waiter, False
+
+    def _wait_for(self, key, entry):
+        """A new Future of entry's job, which gives the job up when it is the last one cancelled."""
+        waiter = Future()
+        entry[1].add(waiter)
+
+        def left(waiter):
+            if not waiter.cancelled():
+                return
+            with self._in_flight_lock:
+                entry[1].discard(waiter)
+                if entry[1] or self.in_flight.get(key) is not entry:
+                    return
+                del self.in_flight[key]
+            entry[0].cancel()  # Outside the lock: it runs finished() right away
+
+        waiter.add_done_callback(left)
+        return waiter
+
+    def reserve(self):
+        """Count one more pending job. Returns False if max_pending jobs are already queued or running."""
+        if self.pending >= self.max_pending:
+            print_strings(general_utils.verbose, f"SERVER: Offload pool is full ({self.pending} pending jobs)")
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        """Account for one submitted job having finished. Loop thread only."""
+        self.pending -= 1
+
+    def shutdown(self):
+        """Drop queued jobs and stop the pool without waiting for running ones."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.parallel is not None and self.parallel is not self.executor:
+            self.parallel.shutdown(wait=False, cancel_futures=True)
+
+    def wake(self):
+        """Make the loop's wakeup_socket readable. Safe from any thread."""
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # A wakeup is already pending, or we are shutting down
+
+    def wake_on_signals(self):
+        """Have the loop woken by every signal, so its handler's effect is seen right away. Main thread only."""
+        signal.set_wakeup_fd(self._wakeup_writer.fileno(), warn_on_full_buffer=False)
+
+    def watch(self, future, key):
+        """Report future through completed() (as key, future) once it is done."""
+        def done(finished):
+            self.completions.append((key, finished))
+            self.wake()
+        future.add_done_callback(done)
+
+    def completed(self):
+        """
+        Drain the wakeup socket and yield every (key, future) that finished
+        since the last call. Loop thread only.
+        """
+        try:
+            while self.wakeup_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.completions:
+            key, future = self.completions.popleft()
+            self.release()
+            yield key, future
+
+
+def result_or_error(future):
+    """The response string computed by an offloaded job, or an error response if it failed."""
+    if future.cancelled():
+        return INTERNAL_ERROR
+    try:
+        return future.result()
+    except Exception as e:
+        print_strings(general_utils.verbose, f"SERVER: ERROR - Offloaded job failed: {e!r}")
+        return INTERNAL_ERROR
+
+
+def copy_outcome(job, waiter):
+    """Finish waiter like job finished, unless waiter was cancelled meanwhile."""
+    try:
+        if job.cancelled():
+            waiter.cancel()
+        elif job.exception() is not None:
+            waiter.set_exception(job.exception())
+        else:
+            waiter.set_result(job.result())
+    except InvalidStateError:
+        pass  # Cancelled by its client since
+
+
+def is_pending(response):
+    """True if handle_message handed the request to the pool instead of answering it."""
+    return isinstance(response, Future)
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+Byte translations of very large inputs split across a process pool.
+
+The input is copied once into a multiprocessing.shared_memory block. Every
+pool process attaches to the block by name and translates its own slice in
+place, so only the block's name and slice bounds are pickled, never the text.
+"""
+import threading
+from concurrent.futures import Future
+from multiprocessing import resource_tracker, shared_memory
+
+
+def start_tracker():
+    """
+    Start multiprocessing's resource tracker before forking a pool that uses
+    shared memory, so the pool processes share it with the parent instead of
+    each starting their own, which would warn about and unlink blocks the
+    parent still owns when they exit.
+    """
+    resource_tracker.ensure_running()
+
+
+def translate_shared(name, start, end, table, allowed):
+    """
+    Pool side: translate bytes start:end of the shared memory block name in
+    place with table. Returns False, leaving the slice as it was, if it holds
+    a byte that is not in allowed.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        view = block.buf[start:end]
+        try:
+            data = bytes(view)
+            if data.translate(None, allowed):
+                return False
+            view[:] = data.translate(table)
+            return True
+        finally:
+            view.release()  # The block cannot be closed while a view of it exists
+    finally:
+        block.close()
+
+
+def parallel_translate(executor, parts, data, table, allowed, finish):
+    """
+    Translate data (not empty) with table in parts jobs on executor, a
+    process pool. Returns a Future of finish(result), where result is a
+    memoryview of the translated bytes, valid only during the call, or None
+    if data holds a byte that is not in allowed. finish runs on the pool's
+    management thread once the last job is done.
+    Cancelling the Future cancels the jobs that have not started. If the
+    executor refuses a job, its exception is raised and nothing is left over.
+    """
+    block = shared_memory.SharedMemory(create=True, size=len(data))
+    block.buf[:len(data)] = data
+    step = -(-len(data) // parts)
+    jobs = []
+    try:
+        for start in range(0, len(data), step):
+            jobs.append(executor.submit(translate_shared, block.name, start, min(start + step, len(data)), table, allowed))
+    except BaseException:
+        # The pool is broken or shut down: the jobs already queued must not outlive the block
+        for job in jobs:
+            job.cancel()
+        block.close()
+        block.unlink()
+        raise
+    future = Future()
+    remaining = [len(jobs)]
+    lock = threading.Lock()
+
+    def job_done(job):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            if future.cancelled():
+                return
+            if not all(job.result() for job in jobs):
+                future.set_result(finish(None))
+                return
+            view = block.buf[:len(data)]
+            try:
+                future.set_result(finish(view))
+            finally:
+                view.release()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            block.close()
+            block.unlink()
+
+    def cancelled(finished):
+        if finished.cancelled():
+            for job in jobs:
+                job.cancel()
+
+    future.add_done_callback(cancelled)
+    for job in jobs:
+        job.add_done_callback(job_done)
+    return future
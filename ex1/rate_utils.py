@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+
+class TokenBucket:
+    """
+    Allows `rate` actions per second on average and bursts of up to `burst`.
+    Tokens are refilled lazily from the time since the last take(), so a
+    bucket costs nothing while nobody uses it.
+    """
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def take(self, rate, burst, now, cost=1):
+        """Take cost tokens if there are enough. Returns False if the action has to be refused."""
+        self.refill(rate, burst, now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    """
+    One TokenBucket per key (a peer address, a username). A rate of 0 turns
+    the limiter off. Buckets that have refilled completely are no different
+    from new ones, so they are dropped when more than max_keys are held.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.prune_at = max_keys  # Grows if pruning frees too little, so pruning stays amortized O(1)
+        self.buckets = {}
+
+    def allow(self, key, now, cost=1):
+        if not self.rate:
+            return True
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.prune_at:
+                self.prune(now)
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+        return bucket.take(self.rate, self.burst, now, cost)
+
+    def prune(self, now):
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(self.rate, self.burst, now)
+            if bucket.tokens >= self.burst:
+                del self.buckets[key]
+        self.prune_at = max(self.max_keys, 2 * len(self.buckets))
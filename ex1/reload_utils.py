@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+import os, time
+from concurrent.futures import ThreadPoolExecutor
+import general_utils
+from general_utils import print_strings
+from server_utils import load_users
+from user_store import UserStore
+
+
+def file_signature(path):
+    """What os.stat tells about path that changes when it is rewritten; None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def diff_users(path, users):
+    """
+    Read the users file and compare it to users.
+    Returns (changed, removed): a dict of the added or changed entries and a
+    set of the usernames that are gone from the file.
+    """
+    new_users = load_users(path)
+    changed = {username: password for username, password in new_users.items() if users.get(username) != password}
+    removed = {username for username in users if username not in new_users}
+    return changed, removed
+
+
+class UsersReloader:
+    """
+    Keeps the users of an event loop in sync with the users file.
+
+    The loop calls check() now and then; it starts a reload when the file's
+    mtime, size or inode changed since the last one (looked at every
+    reload_interval seconds) or when request() was called, e.g. from a
+    SIGHUP handler. Reading and comparing the file runs on a thread of its
+    own, which only reads users. The loop then calls apply(), which writes
+    just the changed entries into users in one step, so a message is always
+    checked against either the old or the new file and a large file costs
+    the loop no more than the lines that changed in it.
+
+    A UserStore is not diffed: the reload thread opens the rebuilt store and
+    apply() switches users over to it.
+    """
+
+    def __init__(self, path, users, interval):
+        self.path = path
+        self.users = users
+        self.interval = interval  # Seconds between mtime checks, 0 to reload on request() only
+        self.signature = file_signature(path)  # Of the file users was last loaded from
+        self.reading = None  # Signature of the file the running reload reads
+        self.next_check = time.monotonic() + interval
+        self.requested = False
+        self.future = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reload")
+
+    def request(self):
+        """Reload at the next check() even if the file looks unchanged. Safe in signal handlers."""
+        self.requested = True
+
+    def timeout(self, now):
+        """Seconds until check() has to run again; None if only request() triggers reloads."""
+        if self.future is not None:
+            return None  # apply() comes first; the loop is woken when the reload finishes
+        if self.requested:
+            return 0.0
+        if not self.interval:
+            return None
+        return max(0.0, self.next_check - now)
+
+    def check(self, now):
+        """Start a reload if one is due. Returns its Future, or None."""
+        if self.future is not None:
+            return None
+        if not self.requested:
+            if not self.interval or now < self.next_check:
+                return None
+            self.next_check = now + self.interval
+            if file_signature(self.path) == self.signature:
+                return None
+        self.requested = False
+        # Taken before reading, so a write during the read triggers another reload
+        self.reading = file_signature(self.path)
+        if isinstance(self.users, UserStore):
+            self.future = self.executor.submit(UserStore, self.path)
+        else:
+            self.future = self.executor.submit(diff_users, self.path, self.users)
+        return self.future
+
+    def apply(self):
+        """
+        Write the result of the finished reload into users. Loop thread only.
+        Returns True if users may have lost entries.
+        """
+        future, self.future = self.future, None
+        try:
+            result = future.result()
+        except Exception as e:
+            print_strings(general_utils.verbose, f"SERVER: ERROR - Reloading {self.path} failed, keeping the current users: {e!r}")
+            return False
+        self.signature = self.reading
+        if isinstance(self.users, UserStore):
+            self.users.replace(result)
+            print_strings(general_utils.verbose, f"SERVER: Reopened user store {self.path}: {len(self.users)} users")
+            return True
+        changed, removed = result
+        self.users.update(changed)
+        for username in removed:
+            del self.users[username]
+        print_strings(general_utils.verbose, f"SERVER: Reloaded {self.path}: {len(changed)} added or changed, {len(removed)} removed, {len(self.users)} users")
+        return bool(removed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
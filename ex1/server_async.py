@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+
+import asyncio
+import signal
+import time
+import general_utils
+from general_utils import print_strings
+from server_utils import handle_message, complete_offloaded, client_deadline, make_offloader, make_rate_limiters, make_result_cache, response_bytes, make_greeting_line, SERVER_FULL_LINE, SERVER_OPTIONS, MESSAGE_TOO_LONG
+from offload_utils import is_pending
+from buffer_utils import BufferPool, RecvBuffer
+
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    """
+    One connected client on the asyncio engine.
+    Keeps the same per-client state dict as the select loop so that
+    handle_message and the authentication state machine are shared.
+    As a BufferedProtocol the loop reads straight into the pooled RecvBuffer.
+    """
+
+    def __init__(self, users, offloader, buffer_pool, connections, limiters, cache, greeting_line):
+        self.users = users
+        self.greeting_line = greeting_line
+        self.limiters = limiters
+        self.cache = cache
+        self.connections = connections  # Open ClientProtocols of this loop, for max_connections
+        self.offloader = offloader
+        self.transport = None
+        self.client = None
+        self.recv_buffer = RecvBuffer(buffer_pool)
+        self.paused = set()  # Reasons reading is paused: "output" and/or "input"
+        self.timer = None  # Handle of the armed timeout, see touch()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if len(self.connections) >= SERVER_OPTIONS["max_connections"]:
+            print_strings(general_utils.verbose, f"SERVER: Too many connections, turning away {transport.get_extra_info('peername')}")
+            transport.write(SERVER_FULL_LINE)
+            transport.close()
+            return
+        self.connections.add(self)
+        transport.set_write_buffer_limits(high=SERVER_OPTIONS["high_water"], low=SERVER_OPTIONS["high_water"] // 4)
+        now = time.monotonic()
+        self.client = {"authenticated": 0, "username": None, "address": transport.get_extra_info("peername"), "connected_at": now, "last_active": now}
+        transport.write(self.greeting_line)
+        self.touch()
+        print_strings(general_utils.verbose, f"SERVER: New connection accepted from {self.client['address']}")
+
+    def get_buffer(self, sizehint):
+        return self.recv_buffer.writable()
+
+    def buffer_updated(self, nbytes):
+        self.recv_buffer.written(nbytes)
+        self.process_lines()
+        if self.client.get("pending") is not None and len(self.recv_buffer) >= SERVER_OPTIONS["max_buffered"]:
+            self.pause("input")
+
+    def pause(self, reason):
+        if not self.paused:
+            self.transport.pause_reading()
+        self.paused.add(reason)
+
+    def resume(self, reason):
+        self.paused.discard(reason)
+        if not self.paused and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def touch(self):
+        """
+        Arm a timer for the client's current deadline, like the select loop's
+        timer wheel: only an earlier deadline re-arms it, a later one is
+        picked up by check_timeout when the armed timer fires.
+        """
+        deadline = client_deadline(self.client)
+        if deadline is None or (self.timer is not None and deadline >= self.client["timer_at"]):
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.client["timer_at"] = deadline
+        self.timer = asyncio.get_running_loop().call_later(max(0.0, deadline - time.monotonic()), self.check_timeout)
+
+    def check_timeout(self):
+        self.timer = None
+        if self.transport.is_closing():
+            return
+        now = time.monotonic()
+        deadline = client_deadline(self.client)
+        if deadline is None or deadline > now:
+            self.touch()  # Active since the timer was armed
+            return
+        print_strings(general_utils.verbose, f"SERVER: Disconnecting client {self.client.get('username') or self.client['address']}: timed out")
+        self.transport.abort()
+
+    def process_lines(self):
+        """
+        Handle every complete line in the receive buffer. Stops while a
+        command runs on the offload pool so responses stay in request order.
+        """
+        buf = self.recv_buffer
+        responses = []  # Written together below, like the select loop's single sendmsg
+        while self.client.get("pending") is None and not self.transport.is_closing():
+            line = buf.next_line()
+            if line is None:
+                if len(buf) > SERVER_OPTIONS["max_line"]:
+                    self.reject_oversized(responses)
+                    return
+                break
+            if len(line) > SERVER_OPTIONS["max_line"]:
+                self.reject_oversized(responses)
+                return
+            if not line:
+                continue
+
+            self.client["last_active"] = time.monotonic()
+            self.client["partial_since"] = None
+            response = handle_message(line, self.client, self.users, self.offloader, self.limiters, self.cache)
+            user_id = self.client.get("username") or self.client["address"]
+            print_strings(general_utils.verbose, f"SERVER: Processed message from {user_id}")
+
+            if response == "DISCONNECT":
+                print_strings(general_utils.verbose, f"SERVER: Disconnecting client {user_id} for unauthorized command attempt before authentication")
+                self.transport.writelines(responses)
+                self.transport.close()
+                return
+            elif is_pending(response):
+                self.client["pending"] = response
+                asyncio.wrap_future(response).add_done_callback(self.offload_done)
+            elif response is not None:
+                responses.append(response_bytes(response))
+                responses.append(b"\n")
+        if responses:
+            self.transport.writelines(responses)
+        buf.trim()
+        if not buf or self.client.get("pending") is not None:
+            self.client["partial_since"] = None
+        elif self.client.get("partial_since") is None:
+            self.client["partial_since"] = time.monotonic()
+        self.touch()
+
+    def reject_oversized(self, responses):
+        """Answer an over-long message with an error and close after it is sent."""
+        print_strings(general_utils.verbose, f"SERVER: Message from {self.client.get('username') or self.client['address']} exceeds {SERVER_OPTIONS['max_line']} bytes, disconnecting")
+        responses.append(MESSAGE_TOO_LONG.encode("utf-8") + b"\n")
+        self.transport.writelines(responses)
+        self.transport.close()
+        self.recv_buffer.release()
+
+    def offload_done(self, wrapped):
+        self.offloader.release()
+        future = self.client["pending"]
+        self.client["pending"] = None
+        if self.transport.is_closing():
+            return
+        self.transport.write(response_bytes(complete_offloaded(self.client, future)) + b"\n")
+        self.process_lines()
+        self.resume("input")
+
+    def pause_writing(self):
+        # The peer is not draining its responses; stop reading new commands
+        # until the transport's write buffer falls back below the low-water mark.
+        self.pause("output")
+
+    def resume_writing(self):
+        self.resume("output")
+
+    def connection_lost(self, exc):
+        if self.client is None:
+            return  # Turned away in connection_made
+        self.connections.discard(self)
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.client.get("pending") is not None:
+            self.client["pending"].cancel()
+        self.recv_buffer.release()
+        print_strings(general_utils.verbose, f"SERVER: Client disconnected: {self.client.get('address', 'unknown')}")
+
+
+async def sync_users(reloader, connections):
+    """
+    Reload the users file whenever reloader says it is due or SIGHUP
+    arrives, then apply --removed-users to the live connections.
+    """
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+
+    def hangup():
+        reloader.request()
+        wakeup.set()
+
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, hangup)
+    while True:
+        try:
+            await asyncio.wait_for(wakeup.wait(), reloader.timeout(time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+        future = reloader.check(time.monotonic())
+        if future is None:
+            continue
+        await asyncio.wait([asyncio.wrap_future(future)])
+        if reloader.apply() and SERVER_OPTIONS["removed_users"] == "disconnect":
+            for protocol in list(connections):
+                username = protocol.client["username"]
+                if username is not None and username not in reloader.users:
+                    print_strings(general_utils.verbose, f"SERVER: Disconnecting client {username}: user was removed")
+                    protocol.transport.abort()
+
+
+async def serve_forever(server_socket, users, reloader):
+    loop = asyncio.get_running_loop()
+    offloader = make_offloader()
+    buffer_pool = BufferPool()
+    connections = set()
+    limiters = make_rate_limiters()
+    cache = make_result_cache()
+    greeting_line = make_greeting_line()
+    # asyncio calls listen(backlog) again on the socket and accepts up to
+    # backlog connections per wakeup, so it has no separate accept budget.
+    server = await loop.create_server(lambda: ClientProtocol(users, offloader, buffer_pool, connections, limiters, cache, greeting_line),
+                                      sock=server_socket, backlog=SERVER_OPTIONS["backlog"])
+    print_strings(general_utils.verbose, f"SERVER: Using {type(loop).__name__} event loop")
+    watcher = asyncio.ensure_future(sync_users(reloader, connections))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+        offloader.shutdown()
+
+
+def serve(server_socket, users, reloader):
+    """
+    Run the asyncio engine on an already listening socket; reloader keeps
+    users in sync with the users file.
+    With --engine uvloop the uvloop event loop is used when it is installed.
+    """
+    if SERVER_OPTIONS["engine"] == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed, falling back to the default asyncio loop.")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(serve_forever(server_socket, users, reloader))
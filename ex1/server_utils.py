@@ -1,20 +1,216 @@
 #!/usr/bin/python3
 
-import math, sys, json, os
+import collections, math, sys, json, os, selectors, socket, string, time
 import general_utils
 from general_utils import print_strings
+from offload_utils import Offloader, BUSY_ERROR, result_or_error
+from auth_utils import is_hashed, verify_password, make_session_token, check_session_token
+from rate_utils import RateLimiter
+from cache_utils import ResultCache
+import vector_utils
+from vector_utils import lcm_many, parentheses_depth_array
+from parallel_utils import parallel_translate
 
 DEFAULT_PORT = 1337
+MESSAGE_MAX_SIZE = 4096
 # Using verbose flag from general_utils
 
+# Event loop backends the server can run on, by --engine name.
+# "default" lets the selectors module pick the best one (epoll on Linux).
+SELECTORS = {
+    name: cls for name, cls in (
+        ("default", selectors.DefaultSelector),
+        ("epoll", getattr(selectors, "EpollSelector", None)),
+        ("kqueue", getattr(selectors, "KqueueSelector", None)),
+        ("poll", getattr(selectors, "PollSelector", None)),
+        ("select", selectors.SelectSelector),
+    ) if cls is not None
+}
 
-def handle_message(message, client, users):
+# Engines that run on asyncio (see server_async.py) instead of a selector.
+ASYNC_ENGINES = ("asyncio", "uvloop")
+
+# Bytes caesar accepts, and per shift a bytes.translate table that lowercases and shifts letters
+CAESAR_ALPHABET = (string.ascii_letters + " ").encode("ascii")
+CAESAR_TABLES = [
+    bytes.maketrans(CAESAR_ALPHABET, ((string.ascii_lowercase[shift:] + string.ascii_lowercase[:shift]) * 2 + " ").encode("ascii"))
+    for shift in range(26)
+]
+
+# Shorter parentheses strings are checked in Python: below about 128 characters that
+# beats NumPy's per-call overhead, from 128 on NumPy wins (see "benchmarks.py parentheses")
+PARENTHESES_ARRAY_MIN = 128
+
+# log10(2): digits per bit, for count_digits
+LOG10_2 = 0.30103
+# An lcm with this many digits costs about twice its digit count (see estimate_cost)
+LCM_QUADRATIC_DIGITS = 20000
+
+MESSAGE_TOO_LONG = json.dumps({"type": "error", "message": "Message too long."})
+
+BATCH_UNKNOWN_COMMAND = {"type": "error", "message": "Unknown command or incorrect format. Please check and try again."}
+
+# Streaming parentheses check (see handle_parentheses_stream)
+PARENTHESES_STREAM_COMMANDS = ("parentheses_begin", "parentheses_chunk", "parentheses_end")
+PARENTHESES_CONTINUE = json.dumps({"type": "parentheses_continue"})
+NO_PARENTHESES_STREAM = json.dumps({"type": "error", "message": "No parentheses stream is open."})
+# Streaming caesar (see caesar_stream_step)
+CAESAR_STREAM_COMMANDS = ("caesar_begin", "caesar_chunk", "caesar_end")
+CAESAR_CONTINUE = json.dumps({"type": "caesar_continue"})
+NO_CAESAR_STREAM = json.dumps({"type": "error", "message": "No caesar stream is open."})
+
+LCM_TOO_LARGE = {"type": "error", "message": "LCM result is too large."}
+
+THROTTLED = json.dumps({"type": "error", "message": "Too many requests. Please slow down."})
+TOO_LARGE = json.dumps({"type": "error", "message": "Request is too large to process."})
+
+# Event counters of this process, printed on SIGUSR1 (see format_stats)
+STATS = collections.Counter()
+
+# Sent on every new connection; make_greeting_line encodes it once per event loop
+GREETING = {"type": "greeting", "message": "Welcome! Please log in."}
+# Sent to connections over max_connections, so encoded once up front, newline included
+SERVER_FULL_LINE = (json.dumps({"type": "error", "message": "Server is full. Please try again later."}) + "\n").encode("utf-8")
+
+# Server options that can be set from the command line as --name value.
+# parse_args overwrites the defaults in place, like general_utils.verbose.
+SERVER_OPTIONS = {
+    "engine": "default",
+    "workers": 1,       # Number of worker processes; more than 1 forks a supervisor
+    "reuseport": 0,     # 1 to let every worker bind its own SO_REUSEPORT socket
+    "pool": "thread",   # "thread" or "process" pool for expensive commands
+    "pool_size": 0,     # Pool workers, 0 for one per CPU
+    "inline_cost": 20000,       # Commands costing more than this run on the pool
+    "max_cost": 50000000,       # Commands costing more than this are rejected
+    "max_line": MESSAGE_MAX_SIZE,   # Longest accepted message in bytes; longer ones get an error and a disconnect
+    "max_buffered": 65536,      # Unprocessed input bytes per connection before reading from it pauses
+    "high_water": 262144,       # Unsent output bytes per connection before reading from it pauses
+    "handshake_timeout": 30,    # Seconds to finish logging in; 0 disables
+    "idle_timeout": 600,        # Seconds a logged in client may send nothing; 0 disables
+    "line_timeout": 30,         # Seconds to complete a started message; 0 disables
+    "backlog": 1024,            # listen() backlog; the kernel caps it at net.core.somaxconn
+    "accept_budget": 64,        # Connections accepted per wakeup before serving the others again
+    "max_connections": 1024,    # Open connections per worker; more are sent SERVER_FULL_LINE and closed
+    "reload_interval": 5,       # Seconds between checks whether users_file changed; 0 reloads on SIGHUP only
+    "removed_users": "keep",    # "keep" or "disconnect" the sessions of users removed by a reload
+    "login_rate": 5.0,          # Login messages per second per client IP address; 0 disables
+    "login_burst": 50,          # Login messages an IP address may send at once
+    "command_rate": 100.0,      # Commands per second per user; 0 disables
+    "command_burst": 200,       # Commands a user may send at once
+    "token_key": "",            # Secret that signs session tokens; empty disables resume
+    "token_key_file": "",       # File to read token_key from, so it does not show up in ps
+    "token_ttl": 3600,          # Seconds a session token stays valid
+    "combined_login": 0,        # 1 to accept the one-message "login" and advertise it in the greeting
+    "max_batch": 10000,         # Commands one batch message may hold
+    "parallel_caesar": 0,       # Characters from which an ASCII caesar is split across a process pool; 0 disables
+    "cache_bytes": 16777216,    # Bytes of lcm, parentheses and caesar responses kept for repeated commands; 0 disables
+    "cache_min_cost": 0,        # Commands cheaper than this (see estimate_cost) are not cached
+    "coalesce": 1,              # 1 to have identical offloaded commands share the job already running
+}
+
+
+def make_offloader():
+    """The Offloader for handle_message, from SERVER_OPTIONS. Each event loop has its own."""
+    return Offloader(SERVER_OPTIONS["pool"], SERVER_OPTIONS["pool_size"], parallel=SERVER_OPTIONS["parallel_caesar"] > 0,
+                     initializer=init_pool_process, initargs=(dict(SERVER_OPTIONS), general_utils.verbose))
+
+
+def init_pool_process(options, verbose):
+    """Give a pool process, which does not start as a fork of the server, the server's options."""
+    SERVER_OPTIONS.update(options)
+    general_utils.verbose = verbose
+
+
+def make_rate_limiters():
+    """Rate limiters for handle_message, from SERVER_OPTIONS. Each event loop has its own."""
+    return {
+        "login": RateLimiter(SERVER_OPTIONS["login_rate"], SERVER_OPTIONS["login_burst"]),
+        "command": RateLimiter(SERVER_OPTIONS["command_rate"], SERVER_OPTIONS["command_burst"]),
+    }
+
+
+def is_throttled(client, limiters):
+    """
+    Take a token for the client's next message: from the bucket of its IP
+    address while it logs in, from its user's bucket afterwards.
+    """
+    if limiters is None:
+        return False
+    if client["authenticated"] < 2:
+        kind, key = "login", client.get("address", ("", 0))[0]
+    else:
+        kind, key = "command", client["username"]
+    if limiters[kind].allow(key, time.monotonic()):
+        return False
+    STATS["throttled_" + kind] += 1
+    return True
+
+
+def make_result_cache():
+    """The ResultCache for handle_message, from SERVER_OPTIONS, or None if caching is off. Each event loop has its own."""
+    if not SERVER_OPTIONS["cache_bytes"]:
+        return None
+    return ResultCache(SERVER_OPTIONS["cache_bytes"], STATS)
+
+
+def cache_key(data):
+    """
+    (key, key_size) under which the response to data can be cached, or None.
+    Arguments that give the same response give the same key: lcm ignores
+    the order and signs of x and y, caesar takes the shift modulo 26.
+    """
+    cmd_type = data.get("type")
+    try:
+        if cmd_type == "lcm" and "values" not in data:
+            x, y = abs(int(data.get("x"))), abs(int(data.get("y")))
+            return ("lcm", min(x, y), max(x, y)), (x.bit_length() + y.bit_length()) // 8
+        if cmd_type == "caesar":
+            text = data.get("text")
+            if isinstance(text, str):
+                return ("caesar", text, int(data.get("shift")) % 26), len(text)
+        if cmd_type == "parentheses":
+            s = data.get("string")
+            if isinstance(s, str):
+                return ("parentheses", s), len(s)
+    except (TypeError, ValueError, OverflowError):
+        pass  # Invalid arguments are answered with an error that is not worth caching
+    return None
+
+
+def cache_response(cache, key, response):
+    """Store response to the command with key (from cache_key) and return it encoded."""
+    encoded = response.encode("utf-8")
+    cache.put(key[0], encoded, key[1])
+    return encoded
+
+
+def format_stats():
+    stats = ", ".join(f"{name}={count}" for name, count in sorted(STATS.items()))
+    lookups = STATS["cache_hits"] + STATS["cache_misses"]
+    if lookups:
+        stats += f", cache_hit_rate={STATS['cache_hits'] / lookups:.1%}"
+    return f"SERVER: Stats of process {os.getpid()}: " + stats
+
+
+def handle_message(message, client, users, offloader=None, limiters=None, cache=None):
     print_strings(general_utils.verbose, "SERVER: Received message from client")
+    STATS["messages"] += 1
+    if is_throttled(client, limiters):
+        print_strings(general_utils.verbose, f"SERVER: Throttling client {client.get('username') or client.get('address')}")
+        if "caesar_shift" in client:
+            # Tell a streaming client which chunk to send again
+            try:
+                return chunk_error(THROTTLED, json.loads(str(message, 'utf-8')))
+            except ValueError:
+                pass
+        return THROTTLED
     try:
-        data = json.loads(message.decode('utf-8'))
+        # str() decodes bytes and memoryviews of the receive buffer alike
+        data = json.loads(str(message, 'utf-8'))
         print_strings(general_utils.verbose, f"SERVER: Message type: {data.get('type', 'unknown')}")
         
-    except json.JSONDecodeError:
+    except ValueError:
+        # JSONDecodeError, bad UTF-8, or an integer literal over Python's digit limit
         print_strings(general_utils.verbose, "SERVER: ERROR - Invalid JSON format received")
         return json.dumps({"type": "error", "message": "Invalid JSON format."})
     #Deal with authentication
@@ -22,12 +218,18 @@ def handle_message(message, client, users):
     fail = json.dumps({"type": "login_failure", "message": "Failed to login."})
     print_strings(general_utils.verbose, f"SERVER: Client authentication state: {client['authenticated']}")
     if client["authenticated"] == 0:
+        if cmd_type == "resume":
+            return resume_session(client, data.get("token"), users)
+        if cmd_type == "login" and SERVER_OPTIONS["combined_login"]:
+            # Username and password in one message: straight to state 2, one round trip less
+            return check_password(client, data.get("username"), data.get("password"), users, offloader)
         if cmd_type != "login_username":
             print_strings(general_utils.verbose, "SERVER: Client sent invalid command before authentication.")
             # Signal to disconnect client for unauthorized command
             return "DISCONNECT"
         username = data.get("username")
-        if username not in users:
+        if not isinstance(username, str) or username not in users:
+            STATS["login_failures"] += 1
             print_strings(general_utils.verbose, f"SERVER: Authentication failed - Username '{username}' not found")
             return fail
         client["username"] = username
@@ -38,44 +240,358 @@ def handle_message(message, client, users):
             print_strings(general_utils.verbose, "SERVER: Client sent non-password message when password was expected.")
             # Signal to disconnect client for unauthorized command
             return "DISCONNECT"
-        password = data.get("password")
-        username = client["username"] 
-        # Check if the username exists in the users dictionary
-        if username not in users:
-            print_strings(general_utils.verbose, f"SERVER: Authentication failed - Username '{username}' not found")
-            return fail
-        if(users[username] != password):
-            print_strings(general_utils.verbose, f"SERVER: Authentication failed - Invalid password for user '{username}'")
-            return fail
-        client["authenticated"] = 2
-        print_strings(general_utils.verbose, f"SERVER: User '{username}' successfully authenticated")
-        return json.dumps({"type": "login_success", "message": f"Hi {username}, good to see you."})
+        return check_password(client, client["username"], data.get("password"), users, offloader)
     elif client["authenticated"] == 2:
         print_strings(general_utils.verbose, "Client is authenticated.")
         pass
     
     # Authenticated user commands
+    if cmd_type in PARENTHESES_STREAM_COMMANDS:
+        return handle_parentheses_stream(cmd_type, data, client)
+    if cmd_type in CAESAR_STREAM_COMMANDS:
+        data = caesar_stream_step(cmd_type, data, client)
+        if isinstance(data, str):
+            return data  # Answered without running anything
+        response = run_command(data, client, offloader, cache)
+        if response in (TOO_LARGE, BUSY_ERROR):
+            return chunk_error(response, data)  # Not run, so the client can send the same seq again
+        client["caesar_seq"] += 1
+        return response
+    return run_command(data, client, offloader, cache)
+
+
+def run_command(data, client, offloader, cache):
+    """
+    The response to an authenticated client's command: from the cache, run
+    inline, or a Future of the pool job, with the continuation for it left
+    in client["then"].
+    """
+    cmd_type = data.get("type")
+    cost = estimate_cost(data)
+    if cost > SERVER_OPTIONS["max_cost"]:
+        STATS["too_large"] += 1
+        print_strings(general_utils.verbose, f"SERVER: Rejecting {cmd_type} command with estimated cost {cost}")
+        return TOO_LARGE
+    offload = offloader is not None and cost > SERVER_OPTIONS["inline_cost"]
+    cacheable = cache is not None and cost >= SERVER_OPTIONS["cache_min_cost"]
+    key = None
+    if cacheable or (offload and SERVER_OPTIONS["coalesce"]):
+        key = cache_key(data)
+    if cacheable and key is not None:
+        cached = cache.get(key[0])
+        if cached is not None:
+            print_strings(general_utils.verbose, f"SERVER: Answering {cmd_type} command from the result cache")
+            return cached
+    if offload:
+        print_strings(general_utils.verbose, f"SERVER: Offloading {cmd_type} command with estimated cost {cost}")
+        if offloader.parallel is not None and is_parallel_caesar(data, cost):
+            start = lambda: offloader.submit_parallel(start_parallel_caesar, data)
+        else:
+            start = lambda: offloader.submit(handle_command, data)
+        if key is not None and SERVER_OPTIONS["coalesce"]:
+            future, shared = offloader.submit_shared(key[0], start)
+        else:
+            future, shared = start(), False
+        if future is None:
+            STATS["busy"] += 1
+            return BUSY_ERROR
+        if shared:
+            STATS["coalesced"] += 1
+            print_strings(general_utils.verbose, f"SERVER: Joining the identical {cmd_type} command already running")
+        else:
+            STATS["offloaded"] += 1
+        if cacheable and key is not None:
+            client["then"] = lambda done: cache_response(cache, key, done.result()) if done.exception() is None else result_or_error(done)
+        return future
+    if cacheable and key is not None:
+        return cache_response(cache, key, handle_command(data))
+    return handle_command(data)
+
+
+def check_password(client, username, password, users, offloader):
+    """
+    The response to a login_password (or login) message: logs the client in
+    as username if password matches. Hashed passwords are checked on the
+    offload pool; the result is then a Future, answered by finish_login.
+    """
+    # Check if the username exists in the users dictionary
+    if not isinstance(username, str) or username not in users:
+        STATS["login_failures"] += 1
+        print_strings(general_utils.verbose, f"SERVER: Authentication failed - Username '{username}' not found")
+        return json.dumps({"type": "login_failure", "message": "Failed to login."})
+    stored = users[username]
+    if is_hashed(stored) and offloader is not None:
+        # Hashing takes tens of milliseconds; check on the pool and answer once it is done
+        future = offloader.submit(verify_password, stored, password)
+        if future is None:
+            STATS["busy"] += 1
+            return BUSY_ERROR
+        client["then"] = lambda done: finish_login(client, username, done.exception() is None and done.result())
+        return future
+    return finish_login(client, username, verify_password(stored, password))
+
+
+def finish_login(client, username, verified):
+    """The response to a login_password whose password check gave verified."""
+    if not verified:
+        STATS["login_failures"] += 1
+        print_strings(general_utils.verbose, f"SERVER: Authentication failed - Invalid password for user '{username}'")
+        return json.dumps({"type": "login_failure", "message": "Failed to login."})
+    client["username"] = username
+    client["authenticated"] = 2
+    STATS["logins"] += 1
+    print_strings(general_utils.verbose, f"SERVER: User '{username}' successfully authenticated")
+    response = {"type": "login_success", "message": f"Hi {username}, good to see you."}
+    if SERVER_OPTIONS["token_key"]:
+        # Lets the client skip the login next time it connects, see resume_session
+        response["token"] = make_session_token(SERVER_OPTIONS["token_key"].encode("utf-8"), username, SERVER_OPTIONS["token_ttl"])
+    return json.dumps(response)
+
+
+def resume_session(client, token, users):
+    """
+    Log a client in with the token of an earlier login_success instead of
+    username and password. The token is checked by its signature alone, so
+    any server process with the same token_key accepts it; the user must
+    still exist.
+    """
+    key = SERVER_OPTIONS["token_key"]
+    username = check_session_token(key.encode("utf-8"), token) if key else None
+    if username is None or username not in users:
+        STATS["login_failures"] += 1
+        print_strings(general_utils.verbose, "SERVER: Authentication failed - Invalid or expired session token")
+        return json.dumps({"type": "login_failure", "message": "Failed to login."})
+    STATS["resumed"] += 1
+    return finish_login(client, username, True)
+
+
+def handle_parentheses_stream(cmd_type, data, client):
+    """
+    parentheses_begin, any number of parentheses_chunk and parentheses_end
+    check one parentheses string sent in pieces, each small enough for a
+    message. Between messages the connection keeps only
+    client["parentheses_depth"]: the depth so far, -1 once it dropped below
+    zero, or None once a chunk held an invalid character. Each chunk costs
+    time in its own length and no memory after it is answered.
+    """
+    if cmd_type == "parentheses_begin":
+        print_strings(general_utils.verbose, "SERVER: Starting parentheses stream")
+        client["parentheses_depth"] = 0  # Replaces a stream that was never ended
+        return PARENTHESES_CONTINUE
+    if "parentheses_depth" not in client:
+        return NO_PARENTHESES_STREAM
+    depth = client["parentheses_depth"]
+    if cmd_type == "parentheses_end":
+        print_strings(general_utils.verbose, "SERVER: Finishing parentheses stream")
+        del client["parentheses_depth"]
+        if depth is None:
+            return json.dumps({"type": "error", "message": "String contains invalid characters."})
+        return json.dumps({"type": "parentheses_result", "result": depth == 0})
+    chunk = data.get("string")
+    if not isinstance(chunk, str):
+        return json.dumps({"type": "error", "message": "Invalid parameters for parentheses check."})
+    if depth is not None:
+        # Once unbalanced, the rest only decides whether the string is also invalid
+        new_depth = parentheses_depth(chunk, max(depth, 0))
+        client["parentheses_depth"] = new_depth if depth >= 0 or new_depth is None else -1
+    return PARENTHESES_CONTINUE
+
+
+def caesar_stream_step(cmd_type, data, client):
+    """
+    caesar_begin (with the shift), caesar_chunk messages numbered 0, 1, ...
+    and caesar_end encrypt a text sent in pieces: every chunk is answered
+    with a caesar_chunk of its own as soon as it arrives, while the client
+    keeps sending. The connection keeps only client["caesar_shift"] and the
+    number it expects next, client["caesar_seq"].
+
+    Returns the response, or for a chunk in sequence the command to run,
+    which carries the shift and goes through the usual cost check and
+    offloading like a caesar message. handle_message moves caesar_seq on
+    once the chunk has been answered or handed to the pool.
+    """
+    if cmd_type == "caesar_begin":
+        try:
+            shift = int(data.get("shift"))
+        except (TypeError, ValueError, OverflowError):  # OverflowError: json reads 1e400 as inf
+            return json.dumps({"type": "error", "message": "Invalid parameters for Caesar cipher."})
+        print_strings(general_utils.verbose, f"SERVER: Starting caesar stream with shift {shift}")
+        client["caesar_shift"], client["caesar_seq"] = shift, 0  # Replaces a stream that was never ended
+        return CAESAR_CONTINUE
+    if "caesar_shift" not in client:
+        return NO_CAESAR_STREAM
+    if cmd_type == "caesar_end":
+        print_strings(general_utils.verbose, "SERVER: Finishing caesar stream")
+        chunks = client.pop("caesar_seq")
+        del client["caesar_shift"]
+        return json.dumps({"type": "caesar_end", "chunks": chunks})
+    seq = data.get("seq")
+    if seq != client["caesar_seq"] or isinstance(seq, bool):
+        return json.dumps({"type": "error", "message": f"Expected chunk {client['caesar_seq']}.", "seq": seq})
+    return {"type": "caesar_chunk", "seq": seq, "text": data.get("text"), "shift": client["caesar_shift"]}
+
+
+def chunk_error(error, data):
+    """error with the seq of data added if data is a caesar_chunk, so that the client knows which chunk it applies to."""
+    if isinstance(data, dict) and data.get("type") == "caesar_chunk":
+        return json.dumps(dict(json.loads(error), seq=data.get("seq")))
+    return error
+
+
+def response_bytes(response):
+    """A response of handle_message or complete_offloaded as bytes; cached ones already are."""
+    return response if isinstance(response, bytes) else response.encode("utf-8")
+
+
+def complete_offloaded(client, future):
+    """
+    The response to client's finished pool job. If handle_message left a
+    continuation for the job, it runs here, on the loop thread, so that only
+    the loop ever changes the client's state.
+    """
+    then = client.pop("then", None)
+    if then is None or future.cancelled():
+        return result_or_error(future)
+    return then(future)
+
+
+def handle_command(data):
+    """
+    Run one command of an authenticated client and return the JSON response.
+    Only depends on data, so it can also run on a pool thread or process.
+    """
+    cmd_type = data.get("type")
     if cmd_type == "lcm":
-        print_strings(general_utils.verbose, f"SERVER: Processing LCM command with values {data.get('x')} and {data.get('y')}")
+        if "values" in data:
+            print_strings(general_utils.verbose, "SERVER: Processing LCM command for a list of values")
+        else:
+            print_strings(general_utils.verbose, f"SERVER: Processing LCM command with values {data.get('x')} and {data.get('y')}")
         return handle_lcm(data)
+    elif cmd_type == "lcm_many":
+        print_strings(general_utils.verbose, "SERVER: Processing LCM command for a list of pairs")
+        return handle_lcm_many(data)
     elif cmd_type == "parentheses":
         print_strings(general_utils.verbose, f"SERVER: Processing parentheses validation for string: {data.get('string')}")
         return handle_parentheses(data)
+    elif cmd_type == "caesar_chunk":
+        return handle_caesar_chunk(data)
     elif cmd_type == "caesar":
         print_strings(general_utils.verbose, f"SERVER: Processing Caesar cipher with shift {data.get('shift')}")
         return handle_caesar(data)
+    elif cmd_type == "batch":
+        print_strings(general_utils.verbose, "SERVER: Processing batch of commands")
+        return handle_batch(data)
     else:
         print_strings(general_utils.verbose, f"SERVER: ERROR - Unknown command type: {cmd_type}")
         # Clear any previous response data to prevent showing it again
         return json.dumps({"type": "error", "message": "Unknown command or incorrect format. Please check and try again."})
 
-def delete_client(client_socket, sockets_list, clients, client_send_buffers, clients_recv_buffers):
+
+def client_deadline(client):
+    """
+    The time.monotonic() value by which the client has to make progress, or
+    None if no timeout applies. Not logged in yet: handshake_timeout after
+    connecting. Logged in: idle_timeout after its last complete message.
+    And, while a message has only partially arrived: line_timeout after its
+    first bytes, so trickling a byte at a time does not keep it alive.
+    """
+    deadlines = []
+    if client["authenticated"] < 2:
+        if SERVER_OPTIONS["handshake_timeout"]:
+            deadlines.append(client["connected_at"] + SERVER_OPTIONS["handshake_timeout"])
+    elif SERVER_OPTIONS["idle_timeout"] and client.get("pending") is None:
+        deadlines.append(client["last_active"] + SERVER_OPTIONS["idle_timeout"])
+    if client.get("partial_since") is not None and SERVER_OPTIONS["line_timeout"]:
+        deadlines.append(client["partial_since"] + SERVER_OPTIONS["line_timeout"])
+    return min(deadlines) if deadlines else None
+
+
+def make_greeting_line():
+    """
+    The encoded greeting, listing the optional login messages the server
+    accepts under "features" so that clients can use them. Built once per
+    event loop, after the options are parsed.
+    """
+    features = []
+    if SERVER_OPTIONS["combined_login"]:
+        features.append("login")
+    if SERVER_OPTIONS["token_key"]:
+        features.append("resume")
+    greeting = dict(GREETING, features=features) if features else GREETING
+    return (json.dumps(greeting) + "\n").encode("utf-8")
+
+
+def count_digits(value):
+    """Number of decimal digits of an lcm argument (int or numeric string), without converting it."""
+    if isinstance(value, int):
+        return int(value.bit_length() * LOG10_2) + 1
+    if isinstance(value, str):
+        return len(value)
+    return 0
+
+
+def fits_json(value):
+    """
+    False if value has more digits than Python converts to a string
+    (sys.get_int_max_str_digits), so json.dumps would raise on it.
+    """
+    limit = sys.get_int_max_str_digits()
+    return not limit or count_digits(value) <= limit
+
+
+def estimate_cost(data):
+    """
+    Estimate how expensive a command is from the size of its input, in
+    characters processed: caesar and parentheses are linear in the text
+    length, while parsing and multiplying the lcm arguments grows
+    quadratically with their digit count.
+    """
+    cmd_type = data.get("type")
+    if cmd_type in ("caesar", "caesar_chunk"):
+        text = data.get("text")
+        return len(text) if isinstance(text, str) else 0
+    if cmd_type == "parentheses":
+        s = data.get("string")
+        return len(s) if isinstance(s, str) else 0
+    if cmd_type == "lcm":
+        values = data.get("values")
+        if isinstance(values, list):
+            # The result can have as many digits as all values together,
+            # and the last levels of lcm_list work on numbers of that size
+            digits = sum(map(count_digits, values))
+        else:
+            digits = count_digits(data.get("x")) + count_digits(data.get("y"))
+        return digits + digits * digits // LCM_QUADRATIC_DIGITS
+    if cmd_type == "lcm_many":
+        # Linear: json.loads refuses ints of more than 4300 digits, so no pair gets quadratic
+        xs, ys = data.get("xs"), data.get("ys")
+        if not isinstance(xs, list) or not isinstance(ys, list):
+            return 0
+        return sum(map(count_digits, xs)) + sum(map(count_digits, ys))
+    if cmd_type == "batch":
+        commands = data.get("commands")
+        if not isinstance(commands, list):
+            return 0
+        # Every command costs at least its dispatch, even a tiny one
+        return len(commands) + sum(estimate_cost(command) for command in commands
+                                   if isinstance(command, dict) and command.get("type") != "batch")
+    return 0
+
+
+def delete_client(client_socket, selector, clients, client_send_buffers, clients_recv_buffers):
     print_strings(general_utils.verbose, f"SERVER: Closing connection with client {clients.get(client_socket, {}).get('username', 'unknown')}")
-    if client_socket in sockets_list:
-        sockets_list.remove(client_socket)
+    pending = clients.get(client_socket, {}).get("pending")
+    if pending is not None:
+        pending.cancel()  # Drops the job if the pool has not started it yet
+    try:
+        selector.unregister(client_socket)
+    except (KeyError, ValueError):
+        pass
     clients.pop(client_socket, None)
     client_send_buffers.pop(client_socket, None)
-    clients_recv_buffers.pop(client_socket, None)
+    recv_buffer = clients_recv_buffers.pop(client_socket, None)
+    if recv_buffer is not None:
+        recv_buffer.release()
     try:
         client_socket.close()
     except OSError:
@@ -106,17 +622,34 @@ def balanced_parentheses(s):
     Check if a parentheses string is balanced.
     Returns True for balanced, False for unbalanced, and None for invalid input.
     """
+    depth = parentheses_depth(s)
+    return None if depth is None else depth == 0
+
+
+def parentheses_depth(s, depth=0):
+    """
+    Nesting depth after s when it starts at depth: -1 if it drops below zero
+    on the way, None if s holds anything but parentheses. Strings of
+    PARENTHESES_ARRAY_MIN characters or more are scanned with NumPy when it
+    is installed.
+    """
+    if len(s) >= PARENTHESES_ARRAY_MIN and vector_utils.np is not None:
+        return parentheses_depth_array(s, depth)
+    return parentheses_depth_chars(s, depth)
+
+
+def parentheses_depth_chars(s, depth=0):
+    """parentheses_depth, one character at a time."""
     if any(ch not in ("(", ")") for ch in s):
         return None
-    count = 0
     for ch in s:
         if ch == "(":
-            count += 1
-        elif ch == ")":
-            count -= 1
-            if count < 0:
-                return False
-    return count == 0
+            depth += 1
+        else:
+            depth -= 1
+            if depth < 0:
+                return -1
+    return depth
 
 
 def lcm(x, y):
@@ -128,12 +661,45 @@ def lcm(x, y):
     return abs(x * y) // math.gcd(x, y)
 
 
+def lcm_list(values):
+    """
+    Least common multiple of a non-empty list of signed ints.
+
+    Reduces neighbouring pairs level by level, like a balanced binary tree,
+    instead of folding left to right: every gcd and multiplication then
+    works on operands of similar size, and only the last levels handle big
+    ones, where a fold grows one huge intermediate and touches it for every
+    remaining value.
+    """
+    while len(values) > 1:
+        paired = [math.lcm(values[i], values[i + 1]) for i in range(0, len(values) - 1, 2)]
+        if len(values) % 2:
+            paired.append(values[-1])
+        values = paired
+    return abs(values[0])
+
+
 def caesar(text, shift):
     """
     Caesar cipher. Only lowercase/uppercase letters and spaces are allowed.
     Output is always lowercase. Handles both positive and negative shifts.
     If invalid chars found, return None.
+
+    ASCII text is checked and shifted by two bytes.translate passes over its
+    encoding, with the table for the shift built at import time. Other text
+    goes through caesar_chars, which defines the result for non-ASCII letters.
     """
+    shift = shift % 26
+    if not text.isascii():
+        return caesar_chars(text, shift)
+    data = text.encode("ascii")
+    if data.translate(None, CAESAR_ALPHABET):
+        return None  # Something other than letters and spaces was left over
+    return data.translate(CAESAR_TABLES[shift]).decode("ascii")
+
+
+def caesar_chars(text, shift):
+    """caesar, one character at a time."""
     result = []
     # Handle negative shifts by converting to equivalent positive shift
     shift = shift % 26
@@ -143,6 +709,8 @@ def caesar(text, shift):
             result.append(" ")
         elif ch.isalpha():
             c = ch.lower()
+            if len(c) != 1:
+                return None  # Letters like "İ" lowercase to two characters
             k = (ord(c) - ord('a') + shift) % 26
             result.append(chr(ord('a') + k))
         else:
@@ -150,11 +718,66 @@ def caesar(text, shift):
     return "".join(result)
 
 
+def parse_options(args):
+    """
+    Remove every "--name value" pair whose name is a key of SERVER_OPTIONS
+    from args and store the value in SERVER_OPTIONS, converted to the type
+    of the default. Returns False if an option value is missing or invalid.
+    """
+    for name, default in SERVER_OPTIONS.items():
+        flag = "--" + name.replace("_", "-")
+        while flag in args:
+            index = args.index(flag)
+            if index + 1 >= len(args):
+                print(f"Missing value for {flag}")
+                return False
+            value = args[index + 1]
+            del args[index:index + 2]
+            try:
+                SERVER_OPTIONS[name] = type(default)(value)
+            except ValueError:
+                print(f"Invalid value for {flag}: {value}")
+                return False
+    if SERVER_OPTIONS["engine"] not in SELECTORS and SERVER_OPTIONS["engine"] not in ASYNC_ENGINES:
+        print(f"Unknown engine: {SERVER_OPTIONS['engine']}. Choose one of: {', '.join(list(SELECTORS) + list(ASYNC_ENGINES))}")
+        return False
+    if SERVER_OPTIONS["pool"] not in ("thread", "process"):
+        print("--pool must be thread or process")
+        return False
+    if SERVER_OPTIONS["token_key_file"]:
+        try:
+            with open(SERVER_OPTIONS["token_key_file"], "r", encoding="utf-8") as file:
+                SERVER_OPTIONS["token_key"] = file.read().strip()
+        except OSError as e:
+            print(f"Cannot read --token-key-file: {e}")
+            return False
+    if SERVER_OPTIONS["removed_users"] not in ("keep", "disconnect"):
+        print("--removed-users must be keep or disconnect")
+        return False
+    if SERVER_OPTIONS["workers"] < 1:
+        print("--workers must be at least 1")
+        return False
+    for name in ("backlog", "accept_budget", "max_connections"):
+        if SERVER_OPTIONS[name] < 1:
+            print(f"--{name.replace('_', '-')} must be at least 1")
+            return False
+    if SERVER_OPTIONS["reuseport"] and not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not supported on this platform")
+        return False
+    return True
+
+
+def usage():
+    options = " ".join(f"[--{name.replace('_', '-')} {str(value).upper() or 'VALUE'}]" for name, value in SERVER_OPTIONS.items())
+    return f"Usage: {os.path.basename(sys.argv[0])} users_file [port] [--verbose] {options}"
+
+
 def parse_args():
     """
-    Read command-line arguments for port number and verbose option.
+    Read command-line arguments for port number, verbose and server options.
     Returns a tuple (users_file, port).
-    Sets the global verbose flag if --verbose is present.
+    Sets the global verbose flag if --verbose is present and fills
+    SERVER_OPTIONS from any --option value pairs.
     """
     # Create a copy of args to process
     args = sys.argv[1:]
@@ -164,10 +787,14 @@ def parse_args():
         general_utils.verbose = True
         args.remove("--verbose")
         print("Verbose mode enabled")  # Direct print to verify flag is processed
+
+    if not parse_options(args):
+        print(usage())
+        sys.exit(1)
     
     # Now check remaining args
     if not (1 <= len(args) <= 2):
-        print(f"Usage: {os.path.basename(sys.argv[0])} users_file [port] [--verbose]")
+        print(usage())
         sys.exit(1)
         
     users_file = args[0]
@@ -198,35 +825,154 @@ def parse_args():
 # Handler function for server.py
 
 
-def handle_lcm(data):
+def compute_lcm(data):
+    if "values" in data:
+        values = data["values"]
+        try:
+            if not isinstance(values, list) or not values:
+                raise ValueError
+            values = [int(value) for value in values]
+        except (TypeError, ValueError, OverflowError):
+            return {"type": "error", "message": "Invalid parameters for LCM."}
+        return lcm_response(lcm_list(values))
     try:
         x = int(data.get("x"))
         y = int(data.get("y"))
-    except (TypeError, ValueError):
-        return json.dumps({"type": "error", "message": "Invalid parameters for LCM."})
+    except (TypeError, ValueError, OverflowError):
+        return {"type": "error", "message": "Invalid parameters for LCM."}
     result = lcm(x, y)
-    return json.dumps({"type": "lcm_result", "result": result})
+    return lcm_response(result)
 
 
-def handle_parentheses(data):
+def lcm_response(result):
+    if not fits_json(result):
+        return LCM_TOO_LARGE
+    return {"type": "lcm_result", "result": result}
+
+
+def compute_lcm_many(data):
+    xs, ys = data.get("xs"), data.get("ys")
+    if (not isinstance(xs, list) or not isinstance(ys, list) or len(xs) != len(ys)
+            or not all(type(v) is int for v in xs) or not all(type(v) is int for v in ys)):
+        return {"type": "error", "message": "Invalid parameters for LCM."}
+    results = lcm_many(xs, ys)
+    if results and not fits_json(max(results)):
+        return LCM_TOO_LARGE
+    return {"type": "lcm_many_result", "results": results}
+
+
+def compute_parentheses(data):
     s = data.get("string")
     if not isinstance(s, str):
-        return json.dumps({"type": "error", "message": "Invalid parameters for parentheses check."})
+        return {"type": "error", "message": "Invalid parameters for parentheses check."}
     result = balanced_parentheses(s)
     if result is None:
-        return json.dumps({"type": "error", "message": "String contains invalid characters."})
-    return json.dumps({"type": "parentheses_result", "result": result})
+        return {"type": "error", "message": "String contains invalid characters."}
+    return {"type": "parentheses_result", "result": result}
 
 
-def handle_caesar(data):
+def compute_caesar(data):
     text = data.get("text")
     try:
         shift = int(data.get("shift"))
-    except (TypeError, ValueError):
-        return json.dumps({"type": "error", "message": "Invalid parameters for Caesar cipher."})
+    except (TypeError, ValueError, OverflowError):
+        return {"type": "error", "message": "Invalid parameters for Caesar cipher."}
     if not isinstance(text, str) or not isinstance(shift, int):
-        return json.dumps({"type": "error", "message": "Invalid parameters for Caesar cipher."})
+        return {"type": "error", "message": "Invalid parameters for Caesar cipher."}
     result = caesar(text, shift)
     if result is None:
-        return json.dumps({"type": "error", "message": "error: invalid input"})
-    return json.dumps({"type": "caesar_result", "result": result})
+        return {"type": "error", "message": "error: invalid input"}
+    return {"type": "caesar_result", "result": result}
+
+
+def compute_caesar_chunk(data):
+    """One chunk of a caesar stream; data comes from caesar_stream_step."""
+    return as_caesar_chunk(data, compute_caesar(data))
+
+
+def as_caesar_chunk(data, response):
+    """The caesar_chunk response for the caesar response of a chunk."""
+    if response["type"] == "caesar_result":
+        return {"type": "caesar_chunk", "seq": data["seq"], "result": response["result"]}
+    return dict(response, seq=data["seq"])
+
+
+def is_parallel_caesar(data, cost):
+    """True if data is a caesar (or caesar_chunk) large enough for start_parallel_caesar."""
+    if not SERVER_OPTIONS["parallel_caesar"] or cost < SERVER_OPTIONS["parallel_caesar"]:
+        return False
+    if data.get("type") not in ("caesar", "caesar_chunk"):
+        return False
+    text = data.get("text")
+    try:
+        int(data.get("shift"))
+    except (TypeError, ValueError, OverflowError):
+        return False
+    # Non-ASCII text is left to caesar_chars on the pool
+    return isinstance(text, str) and text.isascii()
+
+
+def start_parallel_caesar(executor, parts, data):
+    """
+    Run the caesar of data on the process pool executor, split into parts
+    slices of the text in shared memory. Returns a Future of the response.
+    """
+    def finish(result):
+        if result is None:
+            response = {"type": "error", "message": "error: invalid input"}
+        else:
+            response = {"type": "caesar_result", "result": str(result, "ascii")}
+        if data["type"] == "caesar_chunk":
+            response = as_caesar_chunk(data, response)
+        return json.dumps(response)
+
+    shift = int(data["shift"]) % 26
+    return parallel_translate(executor, parts, data["text"].encode("ascii"), CAESAR_TABLES[shift], CAESAR_ALPHABET, finish)
+
+
+# The commands a batch may hold, by type; each returns its response as a dict
+BATCH_COMMANDS = {"lcm": compute_lcm, "lcm_many": compute_lcm_many, "parentheses": compute_parentheses, "caesar": compute_caesar}
+
+
+def compute_batch(data):
+    """
+    Run every command of a batch message and collect their responses, in
+    order, into one batch_result. A command that fails gets its error in
+    its place; the others still run.
+    """
+    commands = data.get("commands")
+    if not isinstance(commands, list) or len(commands) > SERVER_OPTIONS["max_batch"]:
+        return {"type": "error", "message": "Invalid parameters for batch."}
+    results = []
+    for command in commands:
+        # Only look up string types: a list or dict type is not hashable
+        compute = None
+        if isinstance(command, dict) and isinstance(command.get("type"), str):
+            compute = BATCH_COMMANDS.get(command["type"])
+        results.append(compute(command) if compute is not None else BATCH_UNKNOWN_COMMAND)
+    return {"type": "batch_result", "results": results}
+
+
+def handle_lcm(data):
+    return json.dumps(compute_lcm(data))
+
+
+def handle_lcm_many(data):
+    # No spaces after the commas: they would add a byte per result
+    return json.dumps(compute_lcm_many(data), separators=(",", ":"))
+
+
+def handle_parentheses(data):
+    return json.dumps(compute_parentheses(data))
+
+
+def handle_caesar(data):
+    return json.dumps(compute_caesar(data))
+
+
+def handle_caesar_chunk(data):
+    return json.dumps(compute_caesar_chunk(data))
+
+
+def handle_batch(data):
+    return json.dumps(compute_batch(data))
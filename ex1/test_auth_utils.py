@@ -0,0 +1,37 @@
+# test_auth_utils.py
+from auth_utils import hash_password, is_hashed, verify_password, make_session_token, check_session_token
+
+
+def test_pbkdf2_hash_round_trip():
+    stored = hash_password("BetT3RpAas")
+    assert stored.startswith("pbkdf2_sha256$") and is_hashed(stored)
+    assert verify_password(stored, "BetT3RpAas")
+    assert not verify_password(stored, "betterpass")
+    assert hash_password("BetT3RpAas") != stored  # Salted
+
+
+def test_scrypt_hash_round_trip():
+    stored = hash_password("secret", "scrypt")
+    assert stored.startswith("scrypt$")
+    assert verify_password(stored, "secret")
+    assert not verify_password(stored, "secret!")
+
+
+def test_plaintext_and_malformed_entries():
+    assert not is_hashed("plain$text")
+    assert verify_password("plain$text", "plain$text")
+    assert not verify_password("plain", "plain2")
+    assert not verify_password("plain", 123)
+    assert not verify_password("pbkdf2_sha256$x$!!$!!", "anything")
+
+
+def test_session_token_round_trip():
+    token = make_session_token(b"key", "Alice", ttl=60, now=1000)
+    assert check_session_token(b"key", token, now=1059) == "Alice"
+    assert check_session_token(b"key", token, now=1060) is None  # Expired
+    assert check_session_token(b"other key", token, now=1000) is None
+    payload, signature = token.split(".")
+    forged = make_session_token(b"key", "Mallory", ttl=60, now=1000).split(".")[0]
+    assert check_session_token(b"key", f"{forged}.{signature}", now=1000) is None
+    assert check_session_token(b"key", "not a token", now=1000) is None
+    assert check_session_token(b"key", None, now=1000) is None
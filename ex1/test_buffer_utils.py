@@ -0,0 +1,108 @@
+# test_buffer_utils.py
+import socket
+
+from buffer_utils import SendQueue, BufferPool, RecvBuffer
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        data.extend(sock.recv(size - len(data)))
+    return bytes(data)
+
+
+# ---------------------------
+# SendQueue
+# ---------------------------
+def test_send_queue_keeps_every_response_in_order():
+    left, right = socket.socketpair()
+    queue = SendQueue()
+    for i in range(3):
+        queue.append_line(f"response {i}".encode())
+    assert len(queue) == 3 * len(b"response 0\n")
+    sent = queue.flush(left)
+    assert sent == 33 and len(queue) == 0
+    assert receive_exactly(right, sent) == b"response 0\nresponse 1\nresponse 2\n"
+
+
+def test_send_queue_consume_tracks_partial_sends():
+    queue = SendQueue()
+    queue.append(b"abcdef")
+    queue.append(b"ghi")
+    queue.consume(4)
+    assert queue.offset == 4 and len(queue) == 5
+    queue.consume(3)
+    assert list(queue.chunks) == [b"ghi"] and queue.offset == 1
+    queue.consume(2)
+    assert len(queue) == 0 and not queue.chunks and queue.offset == 0
+
+
+def test_send_queue_resumes_after_a_full_socket_buffer():
+    left, right = socket.socketpair()
+    left.setblocking(False)
+    left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    payload = bytes(range(256)) * 4096
+    queue = SendQueue()
+    queue.append(payload)
+    received = bytearray()
+    while len(queue):
+        queue.flush(left)
+        received.extend(right.recv(1 << 20))
+    received.extend(receive_exactly(right, len(payload) - len(received)))
+    assert bytes(received) == payload
+
+
+def test_send_queue_flush_on_empty_queue_sends_nothing():
+    left, right = socket.socketpair()
+    assert SendQueue().flush(left) == 0
+
+
+# ---------------------------
+# RecvBuffer / BufferPool
+# ---------------------------
+def test_recv_buffer_splits_lines_without_copying():
+    left, right = socket.socketpair()
+    pool = BufferPool(64)
+    buf = RecvBuffer(pool)
+    left.sendall(b'{"a": 1}\n{"b": 2}\n{"c"')
+    buf.recv_from(right)
+    first = buf.next_line()
+    assert isinstance(first, memoryview)
+    assert bytes(first) == b'{"a": 1}'
+    assert bytes(buf.next_line()) == b'{"b": 2}'
+    assert buf.next_line() is None
+    left.sendall(b': 3}\n')
+    buf.recv_from(right)
+    assert bytes(buf.next_line()) == b'{"c": 3}'
+    assert buf.next_line() is None
+
+
+def test_recv_buffer_compacts_and_grows_for_long_lines():
+    left, right = socket.socketpair()
+    buf = RecvBuffer(BufferPool(8))
+    left.sendall(b"ab\n0123456789abcdef\n")
+    lines = []
+    while len(lines) < 2:
+        buf.recv_from(right)
+        line = buf.next_line()
+        while line is not None:
+            lines.append(bytes(line))
+            line = buf.next_line()
+    assert lines == [b"ab", b"0123456789abcdef"]
+    assert len(buf.buf) >= 16
+
+
+def test_recv_buffer_returns_empty_buffers_to_the_pool():
+    left, right = socket.socketpair()
+    pool = BufferPool(32)
+    buf = RecvBuffer(pool)
+    left.sendall(b"one\n")
+    buf.recv_from(right)
+    assert bytes(buf.next_line()) == b"one"
+    buf.trim()
+    assert buf.buf is None and len(pool.free) == 1
+    left.sendall(b"partial")
+    buf.recv_from(right)
+    buf.next_line()
+    buf.trim()
+    assert buf.buf is not None and len(pool.free) == 0
@@ -0,0 +1,25 @@
+# test_cache_utils.py
+import collections
+
+from cache_utils import ResultCache, ENTRY_OVERHEAD
+
+
+def test_cache_evicts_least_recently_used_by_size():
+    stats = collections.Counter()
+    cache = ResultCache(3 * (ENTRY_OVERHEAD + 10), stats)
+    for key in "abc":
+        cache.put(key, b"x" * 10)
+    assert cache.get("a") == b"x" * 10  # Now "b" is the least recently used
+    cache.put("d", b"x" * 10)
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("d") is not None
+    assert stats == {"cache_hits": 3, "cache_misses": 1, "cache_evictions": 1}
+    # One large entry pushes out as many small ones as it needs room for
+    cache.put("e", b"x" * (ENTRY_OVERHEAD + 15))
+    assert len(cache) == 2 and cache.size <= cache.max_bytes
+
+
+def test_cache_skips_responses_larger_than_itself():
+    cache = ResultCache(ENTRY_OVERHEAD + 10, collections.Counter())
+    cache.put("big", b"x" * 11)
+    cache.put("key", b"x", key_size=9)
+    assert cache.get("big") is None and cache.get("key") == b"x"
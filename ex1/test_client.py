@@ -216,6 +216,42 @@ class TestClient:
             self.log(f"Unexpected response type: {response.get('type')}")
             return False, None
 
+    def test_caesar_stream(self, text, shift, chunk_size=1000, window=8):
+        """
+        Test the streaming Caesar cipher: send text in numbered chunks, up to
+        window of them ahead of the results, and join the results.
+        """
+        if not self.authenticated:
+            self.log("Error: Not authenticated")
+            return False, None
+
+        if not self.send_message(json.dumps({"type": "caesar_begin", "shift": shift})):
+            return False, None
+        response = self.receive_response()
+        if not response or response.get("type") != "caesar_continue":
+            return False, None
+
+        chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        results = []
+        sent = 0
+        while len(results) < len(chunks):
+            while sent < len(chunks) and sent - len(results) < window:
+                if not self.send_message(json.dumps({"type": "caesar_chunk", "seq": sent, "text": chunks[sent]})):
+                    return False, None
+                sent += 1
+            response = self.receive_response()
+            if not response or response.get("type") != "caesar_chunk" or response.get("seq") != len(results):
+                self.log(f"Unexpected response: {response}")
+                return False, None
+            results.append(response.get("result"))
+
+        if not self.send_message(json.dumps({"type": "caesar_end"})):
+            return False, None
+        response = self.receive_response()
+        if not response or response.get("type") != "caesar_end":
+            return False, None
+        return True, "".join(results)
+
 def test_send_unknown_command_before_auth(host, port, verbose=False):
     """Test sending unknown command before authentication."""
     print("\n=== Testing disconnection on unknown command before authentication ===")
@@ -453,6 +489,15 @@ def run_single_client_test(host, port, username, password, verbose=False):
         else:
             print(f"✓ Caesar test passed for '{text}',{shift}")
     
+    # Test the streaming Caesar cipher on a text longer than one message
+    text = "Streaming Caesar " * 1000
+    success, result = client.test_caesar_stream(text, 5)
+    if not success or result != "".join(chr((ord(c) - ord('a') + 5) % 26 + ord('a')) if c != " " else c for c in text.lower()):
+        print("✗ Caesar stream test failed")
+        all_passed = False
+    else:
+        print(f"✓ Caesar stream test passed for {len(text)} characters")
+
     client.disconnect()
     
     if all_passed:
@@ -0,0 +1,77 @@
+# test_ex1_server.py
+import selectors
+import socket
+from concurrent.futures import Future
+import pytest
+
+from ex1_server import set_interest
+from buffer_utils import SendQueue, BufferPool, RecvBuffer
+from server_utils import SERVER_OPTIONS
+
+
+@pytest.fixture(autouse=True)
+def restore_server_options():
+    saved = dict(SERVER_OPTIONS)
+    yield
+    SERVER_OPTIONS.clear()
+    SERVER_OPTIONS.update(saved)
+
+
+@pytest.fixture
+def connection():
+    left, right = socket.socketpair()
+    selector = selectors.DefaultSelector()
+    selector.register(left, selectors.EVENT_READ)
+    client = {"authenticated": 2, "username": "Alice", "output_paused": False}
+    yield selector, left, client, SendQueue(), RecvBuffer(BufferPool(64))
+    selector.close()
+    left.close()
+    right.close()
+
+
+def events(selector, sock):
+    key = selector.get_map().get(sock)
+    return key.events if key is not None else 0
+
+
+# ---------------------------
+# set_interest
+# ---------------------------
+def test_write_interest_only_while_output_is_queued(connection):
+    selector, sock, client, send_queue, recv_buffer = connection
+    send_queue.append(b"response\n")
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == selectors.EVENT_READ | selectors.EVENT_WRITE
+    send_queue.consume(len(send_queue))
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == selectors.EVENT_READ
+
+
+def test_reading_pauses_above_high_water_until_drained(connection):
+    selector, sock, client, send_queue, recv_buffer = connection
+    SERVER_OPTIONS["high_water"] = 100
+    send_queue.append(b"x" * 101)
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == selectors.EVENT_WRITE
+    send_queue.consume(50)  # Still above a quarter of high_water
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == selectors.EVENT_WRITE
+    send_queue.consume(51)
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == selectors.EVENT_READ
+
+
+def test_reading_pauses_at_max_buffered_input(connection):
+    selector, sock, client, send_queue, recv_buffer = connection
+    SERVER_OPTIONS["max_buffered"] = 8
+    recv_buffer.writable()
+    recv_buffer.written(8)
+    # Without a pooled job the input is one unfinished line, which has to be read to the end
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == selectors.EVENT_READ
+    client["pending"] = Future()
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == 0
+    recv_buffer.release()
+    set_interest(selector, sock, client, send_queue, recv_buffer)
+    assert events(selector, sock) == selectors.EVENT_READ
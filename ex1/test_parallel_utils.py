@@ -0,0 +1,50 @@
+# test_parallel_utils.py
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import pytest
+
+from parallel_utils import parallel_translate, start_tracker
+from server_utils import CAESAR_ALPHABET, CAESAR_TABLES
+
+
+@pytest.fixture(scope="module")
+def executor():
+    start_tracker()
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        yield pool
+
+
+def test_parallel_translate_reassembles_the_parts_in_order(executor):
+    data = b"Hello World abc XYZ " * 1001
+    future = parallel_translate(executor, 3, data, CAESAR_TABLES[3], CAESAR_ALPHABET, bytes)
+    assert future.result(timeout=30) == data.translate(CAESAR_TABLES[3])
+
+
+def test_parallel_translate_reports_bytes_outside_allowed(executor):
+    data = b"abc " * 1000 + b"!" + b"abc " * 1000
+    future = parallel_translate(executor, 4, data, CAESAR_TABLES[1], CAESAR_ALPHABET, lambda result: result)
+    assert future.result(timeout=30) is None
+
+
+class RefusingExecutor:
+    """Takes one job without running it, then refuses like a broken pool."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, name, *args):
+        if self.jobs:
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        self.name = name
+        self.jobs.append(Future())
+        return self.jobs[-1]
+
+
+def test_parallel_translate_unlinks_the_block_when_a_job_is_refused():
+    executor = RefusingExecutor()
+    with pytest.raises(RuntimeError):
+        parallel_translate(executor, 2, b"abc " * 100, CAESAR_TABLES[1], CAESAR_ALPHABET, bytes)
+    assert executor.jobs[0].cancelled()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=executor.name)
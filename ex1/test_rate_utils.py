@@ -0,0 +1,30 @@
+# test_rate_utils.py
+from rate_utils import RateLimiter
+
+
+def test_bucket_allows_a_burst_then_the_rate():
+    limiter = RateLimiter(rate=2, burst=3)
+    assert [limiter.allow("ip", 0.0) for _ in range(4)] == [True, True, True, False]
+    assert not limiter.allow("ip", 0.25)  # Half a token refilled
+    assert limiter.allow("ip", 0.5)
+    assert limiter.allow("other", 0.5)  # Every key has its own bucket
+
+
+def test_refill_is_capped_at_the_burst():
+    limiter = RateLimiter(rate=10, burst=2)
+    assert limiter.allow("ip", 0.0)
+    assert [limiter.allow("ip", 100.0) for _ in range(3)] == [True, True, False]
+
+
+def test_zero_rate_disables_the_limiter():
+    limiter = RateLimiter(rate=0, burst=1)
+    assert all(limiter.allow("ip", 0.0) for _ in range(100))
+    assert not limiter.buckets
+
+
+def test_idle_buckets_are_pruned():
+    limiter = RateLimiter(rate=1, burst=1, max_keys=10)
+    for i in range(10):
+        limiter.allow(i, 0.0)
+    limiter.allow("new", 5.0)  # Everything else refilled by now
+    assert list(limiter.buckets) == ["new"]
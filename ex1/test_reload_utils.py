@@ -0,0 +1,49 @@
+# test_reload_utils.py
+import os
+import time
+
+from reload_utils import UsersReloader, diff_users
+
+
+def write_users(path, users):
+    path.write_text("".join(f"{username}\t{password}\n" for username, password in users.items()))
+
+
+def test_diff_users_reports_only_changed_entries(tmp_path):
+    path = tmp_path / "users.txt"
+    write_users(path, {"Alice": "a", "Bob": "new", "Carol": "c"})
+    changed, removed = diff_users(path, {"Alice": "a", "Bob": "old", "Dave": "d"})
+    assert changed == {"Bob": "new", "Carol": "c"}
+    assert removed == {"Dave"}
+
+
+def test_reloader_applies_a_changed_file(tmp_path):
+    path = tmp_path / "users.txt"
+    write_users(path, {"Alice": "a", "Bob": "b"})
+    users = {"Alice": "a", "Bob": "b"}
+    reloader = UsersReloader(str(path), users, interval=1)
+    now = time.monotonic()
+    assert reloader.check(now + 1) is None  # Unchanged file
+
+    write_users(path, {"Alice": "a2", "Carol": "c"})
+    os.utime(path, ns=(0, 0))  # A different mtime, even on coarse clocks
+    future = reloader.check(now + 2)
+    assert future is not None and reloader.timeout(now + 2) is None
+    future.result()
+    assert reloader.apply() is True  # Bob was removed
+    assert users == {"Alice": "a2", "Carol": "c"}
+    reloader.shutdown()
+
+
+def test_reloader_request_forces_a_reload(tmp_path):
+    path = tmp_path / "users.txt"
+    write_users(path, {"Alice": "a"})
+    users = {}
+    reloader = UsersReloader(str(path), users, interval=0)
+    assert reloader.timeout(time.monotonic()) is None
+    reloader.request()
+    assert reloader.timeout(time.monotonic()) == 0.0
+    reloader.check(time.monotonic()).result()
+    reloader.apply()
+    assert users == {"Alice": "a"}
+    reloader.shutdown()
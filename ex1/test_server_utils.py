@@ -0,0 +1,463 @@
+# test_server_utils.py
+import json
+import math
+import os
+import signal
+import socket
+import threading
+import time
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+
+import server_utils
+from server_utils import parse_options, client_deadline, SERVER_OPTIONS, LCM_QUADRATIC_DIGITS
+from offload_utils import Offloader, is_pending, result_or_error, BUSY_ERROR
+from auth_utils import hash_password
+
+
+@pytest.fixture(autouse=True)
+def restore_server_options():
+    saved = dict(SERVER_OPTIONS)
+    yield
+    SERVER_OPTIONS.clear()
+    SERVER_OPTIONS.update(saved)
+
+
+# ---------------------------
+# parse_options
+# ---------------------------
+def test_parse_options_removes_known_options():
+    args = ["users.txt", "--engine", "select", "1400"]
+    assert parse_options(args)
+    assert args == ["users.txt", "1400"]
+    assert SERVER_OPTIONS["engine"] == "select"
+
+
+def test_parse_options_rejects_unknown_engine():
+    assert not parse_options(["users.txt", "--engine", "nope"])
+
+
+def test_parse_options_missing_value():
+    assert not parse_options(["users.txt", "--engine"])
+
+
+def test_default_engine_is_available():
+    assert "default" in server_utils.SELECTORS
+    assert "select" in server_utils.SELECTORS
+
+
+def test_parse_options_converts_to_default_type():
+    args = ["users.txt", "--workers", "4"]
+    assert parse_options(args)
+    assert SERVER_OPTIONS["workers"] == 4
+
+
+def test_parse_options_rejects_non_integer():
+    assert not parse_options(["users.txt", "--workers", "many"])
+
+
+def test_parse_options_rejects_zero_workers():
+    assert not parse_options(["users.txt", "--workers", "0"])
+
+
+def test_parse_options_rejects_zero_accept_budget():
+    assert not parse_options(["users.txt", "--accept-budget", "0"])
+
+
+# ---------------------------
+# estimate_cost / offloading
+# ---------------------------
+def authenticated_client():
+    return {"authenticated": 2, "username": "Alice"}
+
+
+def test_estimate_cost_grows_with_input_size():
+    assert server_utils.estimate_cost({"type": "caesar", "text": "abc", "shift": 1}) == 3
+    assert server_utils.estimate_cost({"type": "parentheses", "string": "()" * 10}) == 20
+    small = server_utils.estimate_cost({"type": "lcm", "x": "12", "y": "34"})
+    large = server_utils.estimate_cost({"type": "lcm", "x": "1" * 5000, "y": "2" * 5000})
+    assert small == 4
+    assert large > 10000
+    assert server_utils.estimate_cost({"type": "lcm", "x": 10 ** 20, "y": 7}) == 22
+
+
+def test_handle_message_rejects_requests_over_max_cost():
+    SERVER_OPTIONS["max_cost"] = 10
+    response = server_utils.handle_message(b'{"type": "caesar", "text": "hello world", "shift": 1}', authenticated_client(), {})
+    assert json.loads(response)["type"] == "error"
+
+
+def test_handle_message_offloads_expensive_requests():
+    SERVER_OPTIONS["inline_cost"] = 5
+    offloader = Offloader("thread", 1)
+    message = b'{"type": "caesar", "text": "hello world", "shift": 1}'
+    future = server_utils.handle_message(message, authenticated_client(), {}, offloader)
+    assert is_pending(future)
+    assert json.loads(result_or_error(future)) == {"type": "caesar_result", "result": "ifmmp xpsme"}
+    # Cheap requests still run inline
+    response = server_utils.handle_message(b'{"type": "lcm", "x": 4, "y": 6}', authenticated_client(), {}, offloader)
+    assert json.loads(response) == {"type": "lcm_result", "result": 12}
+
+
+def test_hashed_password_is_verified_on_the_pool():
+    users = {"Alice": hash_password("secret")}
+    offloader = Offloader("thread", 1)
+    client = {"authenticated": 1, "username": "Alice"}
+    future = server_utils.handle_message(b'{"type": "login_password", "password": "secret"}', client, users, offloader)
+    assert is_pending(future) and client["authenticated"] == 1
+    future.result()
+    # The state only changes when the loop thread picks up the result
+    assert json.loads(server_utils.complete_offloaded(client, future))["type"] == "login_success"
+    assert client["authenticated"] == 2 and "then" not in client
+
+    client = {"authenticated": 1, "username": "Alice"}
+    future = server_utils.handle_message(b'{"type": "login_password", "password": "wrong"}', client, users, offloader)
+    future.result()
+    assert json.loads(server_utils.complete_offloaded(client, future))["type"] == "login_failure"
+    assert client["authenticated"] == 1
+
+
+def test_login_username_that_is_not_a_string_fails():
+    for message in (b'{"type": "login_username"}', b'{"type": "login_username", "username": ["Alice"]}'):
+        client = {"authenticated": 0, "username": None}
+        assert json.loads(server_utils.handle_message(message, client, {"Alice": "secret"}))["type"] == "login_failure"
+        assert client["authenticated"] == 0
+
+
+def test_resume_logs_in_with_the_token_of_an_earlier_login():
+    SERVER_OPTIONS["token_key"] = "secret key"
+    users = {"Alice": "secret"}
+    client = {"authenticated": 1, "username": "Alice"}
+    response = json.loads(server_utils.handle_message(b'{"type": "login_password", "password": "secret"}', client, users))
+    assert response["type"] == "login_success"
+
+    resumed = {"authenticated": 0, "username": None}
+    message = json.dumps({"type": "resume", "token": response["token"]}).encode()
+    assert json.loads(server_utils.handle_message(message, resumed, users))["type"] == "login_success"
+    assert resumed["authenticated"] == 2 and resumed["username"] == "Alice"
+
+    # Not for a removed user, and not without a key
+    assert json.loads(server_utils.handle_message(message, {"authenticated": 0, "username": None}, {}))["type"] == "login_failure"
+    SERVER_OPTIONS["token_key"] = ""
+    assert json.loads(server_utils.handle_message(message, {"authenticated": 0, "username": None}, users))["type"] == "login_failure"
+
+
+def test_combined_login_only_when_enabled_and_advertised():
+    users = {"Alice": "secret"}
+    message = b'{"type": "login", "username": "Alice", "password": "secret"}'
+    assert server_utils.handle_message(message, {"authenticated": 0, "username": None}, users) == "DISCONNECT"
+    assert b"features" not in server_utils.make_greeting_line()
+
+    SERVER_OPTIONS["combined_login"] = 1
+    assert json.loads(server_utils.make_greeting_line())["features"] == ["login"]
+    client = {"authenticated": 0, "username": None}
+    assert json.loads(server_utils.handle_message(message, client, users))["type"] == "login_success"
+    assert client == {"authenticated": 2, "username": "Alice"}
+    wrong = b'{"type": "login", "username": "Alice", "password": "guess"}'
+    client = {"authenticated": 0, "username": None}
+    assert json.loads(server_utils.handle_message(wrong, client, users))["type"] == "login_failure"
+    assert client["authenticated"] == 0
+
+
+def test_handle_message_throttles_by_address_and_by_user():
+    SERVER_OPTIONS.update(login_rate=1.0, login_burst=1, command_rate=1.0, command_burst=2)
+    limiters = server_utils.make_rate_limiters()
+    users = {"Alice": "secret"}
+    login = b'{"type": "login_username", "username": "Alice"}'
+    client = {"authenticated": 0, "username": None, "address": ("10.0.0.1", 5000)}
+    assert json.loads(server_utils.handle_message(login, client, users, None, limiters))["type"] == "continue"
+    # Another connection from the same address shares the bucket
+    other = {"authenticated": 0, "username": None, "address": ("10.0.0.1", 5001)}
+    assert server_utils.handle_message(login, other, users, None, limiters) == server_utils.THROTTLED
+    command = b'{"type": "lcm", "x": 4, "y": 6}'
+    responses = [server_utils.handle_message(command, authenticated_client(), users, None, limiters) for _ in range(3)]
+    assert responses[2] == server_utils.THROTTLED and responses[1] != server_utils.THROTTLED
+    assert server_utils.STATS["throttled_login"] >= 1 and server_utils.STATS["throttled_command"] >= 1
+
+
+def test_batch_runs_every_command_and_keeps_errors_in_place():
+    message = json.dumps({"type": "batch", "commands": [
+        {"type": "lcm", "x": 4, "y": 6},
+        {"type": "caesar", "text": "abc", "shift": 1},
+        {"type": "lcm", "x": "four", "y": 6},
+        {"type": "batch", "commands": []},
+        "not a command",
+        {"type": ["lcm"]},
+        {"type": {"lcm": 1}},
+        {"type": "parentheses", "string": "(())"},
+    ]}).encode()
+    response = json.loads(server_utils.handle_message(message, authenticated_client(), {}))
+    assert response["type"] == "batch_result"
+    assert [result["type"] for result in response["results"]] == [
+        "lcm_result", "caesar_result", "error", "error", "error", "error", "error", "parentheses_result"]
+    assert response["results"][0]["result"] == 12 and response["results"][1]["result"] == "bcd"
+
+
+def test_infinite_numbers_are_invalid_parameters():
+    # json.loads reads 1e400 as inf, which int() refuses with OverflowError
+    cache = server_utils.make_result_cache()
+    for message in (b'{"type": "caesar", "text": "abc", "shift": 1e400}',
+                    b'{"type": "lcm", "x": -1e400, "y": 6}',
+                    b'{"type": "lcm", "values": [4, 1e400]}',
+                    b'{"type": "batch", "commands": [{"type": "caesar", "text": "abc", "shift": 1e400}]}',
+                    b'{"type": "caesar_begin", "shift": 1e400}'):
+        response = json.loads(server_utils.handle_message(message, authenticated_client(), {}, None, None, cache))
+        assert "error" in (response["type"], response.get("results", [{}])[0].get("type"))
+
+
+def test_batch_cost_is_the_sum_of_its_commands():
+    commands = [{"type": "caesar", "text": "x" * 100, "shift": 1}] * 3
+    assert server_utils.estimate_cost({"type": "batch", "commands": commands}) == 303
+    SERVER_OPTIONS["max_batch"] = 2
+    response = server_utils.handle_message(json.dumps({"type": "batch", "commands": commands}).encode(), authenticated_client(), {})
+    assert json.loads(response)["type"] == "error"
+
+
+def test_offloader_reports_completions_on_the_wakeup_socket():
+    offloader = Offloader("thread", 1)
+    future = offloader.submit(str.upper, "done")
+    offloader.watch(future, "key")
+    future.result()
+    offloader.wakeup_socket.setblocking(True)
+    offloader.wakeup_socket.settimeout(5)
+    offloader.wakeup_socket.recv(1, socket.MSG_PEEK)
+    offloader.wakeup_socket.setblocking(False)
+    assert [(key, f.result()) for key, f in offloader.completed()] == [("key", "DONE")]
+    assert offloader.pending == 0
+
+
+def test_offloader_rejects_when_full():
+    offloader = Offloader("thread", 1, max_pending=1)
+    assert offloader.submit(time.sleep, 0.01) is not None
+    assert offloader.submit(time.sleep, 0.01) is None
+
+
+def test_process_pool_gets_the_server_options():
+    SERVER_OPTIONS.update(pool="process", pool_size=1, max_batch=1)
+    offloader = server_utils.make_offloader()
+    try:
+        batch = {"type": "batch", "commands": [{"type": "lcm", "x": 4, "y": 6}] * 2}
+        assert json.loads(offloader.submit(server_utils.handle_command, batch).result(timeout=30))["type"] == "error"
+    finally:
+        offloader.shutdown()
+
+
+def test_offloader_replaces_a_broken_process_pool():
+    offloader = Offloader("process", 1)
+    try:
+        os.kill(offloader.submit(os.getpid).result(timeout=30), signal.SIGKILL)
+        # Jobs submitted before the pool notices fail; once it has, submit gives None instead of raising
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            future = offloader.submit(str.upper, "x")
+            if future is None:
+                break
+            assert isinstance(future.exception(timeout=30), BrokenProcessPool)
+        assert offloader.submit(str.upper, "x").result(timeout=30) == "X"
+    finally:
+        offloader.shutdown()
+
+
+def test_offloader_replaces_a_broken_parallel_pool():
+    offloader = Offloader("thread", 1, parallel=True)
+    data = {"type": "caesar", "text": "Hello World " * 50, "shift": 1}
+    try:
+        os.kill(offloader.parallel.submit(os.getpid).result(timeout=30), signal.SIGKILL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            future = offloader.submit_parallel(server_utils.start_parallel_caesar, data)
+            if future is None:
+                break
+            assert isinstance(future.exception(timeout=30), BrokenProcessPool)
+        future = offloader.submit_parallel(server_utils.start_parallel_caesar, data)
+        assert json.loads(future.result(timeout=30))["result"] == "ifmmp xpsme " * 50
+    finally:
+        offloader.shutdown()
+
+
+def test_identical_offloaded_commands_share_one_job():
+    SERVER_OPTIONS["inline_cost"] = 5
+    offloader = Offloader("thread", 1)
+    release = threading.Event()
+    offloader.submit(release.wait)  # Keeps the commands below queued
+    message = b'{"type": "lcm", "x": 123456789012345678901234567890, "y": 98765}'
+    first, second = authenticated_client(), authenticated_client()
+    first_future = server_utils.handle_message(message, first, {}, offloader)
+    second_future = server_utils.handle_message(b'{"type": "lcm", "x": 98765, "y": -123456789012345678901234567890}', second, {}, offloader)
+    assert first_future is not second_future and server_utils.STATS["coalesced"] >= 1
+    assert offloader.pending == 3 and len(offloader.in_flight) == 1
+    # The first client leaving does not cancel the job the second one still waits for
+    first_future.cancel()
+    release.set()
+    assert json.loads(second_future.result(timeout=5)) == {"type": "lcm_result", "result": math.lcm(123456789012345678901234567890, 98765)}
+    assert not offloader.in_flight
+
+
+def test_shared_job_is_cancelled_when_every_client_leaves():
+    offloader = Offloader("thread", 1)
+    release = threading.Event()
+    offloader.submit(release.wait)
+    job_started = []
+    futures = [offloader.submit_shared("key", lambda: offloader.submit(job_started.append, 1))[0] for _ in range(2)]
+    for future in futures:
+        future.cancel()
+    release.set()
+    offloader.executor.shutdown(wait=True)
+    assert not job_started and not offloader.in_flight
+
+
+def test_client_deadline_covers_handshake_idle_and_partial_lines():
+    SERVER_OPTIONS.update(handshake_timeout=30, idle_timeout=600, line_timeout=10)
+    client = {"authenticated": 0, "connected_at": 100.0, "last_active": 100.0}
+    assert client_deadline(client) == 130.0
+    client.update(authenticated=2, last_active=150.0)
+    assert client_deadline(client) == 750.0
+    client["partial_since"] = 160.0
+    assert client_deadline(client) == 170.0
+    SERVER_OPTIONS.update(idle_timeout=0, line_timeout=0)
+    assert client_deadline(client) is None
+
+
+def test_lcm_many_answers_every_pair_in_one_compact_response():
+    message = json.dumps({"type": "lcm_many", "xs": [4, 2 ** 64, 0], "ys": [6, 3, 5]}).encode()
+    response = server_utils.handle_message(message, authenticated_client(), {})
+    assert response == '{"type":"lcm_many_result","results":[12,%d,0]}' % (3 * 2 ** 64)
+    for bad in ({"xs": [1, 2], "ys": [3]}, {"xs": [1, "2"], "ys": [3, 4]}, {"xs": 1, "ys": 2}):
+        response = server_utils.handle_message(json.dumps(dict(bad, type="lcm_many")).encode(), authenticated_client(), {})
+        assert json.loads(response)["type"] == "error"
+    assert server_utils.estimate_cost({"type": "lcm_many", "xs": [10, 2], "ys": [7, 100]}) == 7
+
+
+def test_lcm_of_a_values_list_matches_a_fold():
+    values = [12, -18, "35", 2 ** 70, 11, 1]
+    response = server_utils.handle_command({"type": "lcm", "values": values})
+    assert json.loads(response) == {"type": "lcm_result", "result": math.lcm(*map(int, values))}
+    assert server_utils.lcm_list([7]) == 7 and server_utils.lcm_list([-4, 6, 0]) == 0
+    for bad in ([], [1, "two"], "1 2"):
+        assert json.loads(server_utils.handle_command({"type": "lcm", "values": bad}))["type"] == "error"
+
+
+def test_lcm_values_cost_counts_every_digit_and_is_checked_up_front():
+    values = ["9" * 4000] * 100
+    assert server_utils.estimate_cost({"type": "lcm", "values": values}) == 400000 + 400000 ** 2 // LCM_QUADRATIC_DIGITS
+    SERVER_OPTIONS["max_cost"] = 1000000
+    message = json.dumps({"type": "lcm", "values": values}).encode()
+    assert json.loads(server_utils.handle_message(message, authenticated_client(), {}))["type"] == "error"
+
+
+def test_lcm_results_too_long_for_json_are_an_error():
+    response = server_utils.handle_command({"type": "lcm", "x": "7" * 3000, "y": "3" * 2999 + "1"})
+    assert json.loads(response) == server_utils.LCM_TOO_LARGE
+    response = server_utils.handle_command({"type": "lcm_many", "xs": [4, 10 ** 3000 + 1], "ys": [6, 10 ** 3000 + 3]})
+    assert json.loads(response) == server_utils.LCM_TOO_LARGE
+
+
+def test_caesar_tables_match_the_character_loop():
+    texts = ["Hello World", "", "   ", "abc xyz ABC XYZ", "no digits 1", "tab\there", "café", "Straße"]
+    for text in texts:
+        for shift in (-27, -1, 0, 3, 25, 26, 1000):
+            assert server_utils.caesar(text, shift) == server_utils.caesar_chars(text, shift)
+    assert server_utils.caesar("Hello World", 3) == "khoor zruog"
+    assert server_utils.caesar("bad!", 1) is None
+    assert server_utils.caesar("İstanbul", 1) is None
+
+
+def stream_parentheses(client, chunks):
+    responses = [server_utils.handle_message(json.dumps(message).encode(), client, {}) for message in
+                 [{"type": "parentheses_begin"}] + [{"type": "parentheses_chunk", "string": chunk} for chunk in chunks]
+                 + [{"type": "parentheses_end"}]]
+    assert all(response == server_utils.PARENTHESES_CONTINUE for response in responses[:-1])
+    return json.loads(responses[-1])
+
+
+def test_parentheses_stream_matches_the_whole_string():
+    client = authenticated_client()
+    for chunks in (["((", "()", "))"], ["(" * 300, ")" * 300], [")(", "()"], ["((", "x", ")"], [")", "x"], [], ["(", ""]):
+        expected = json.loads(server_utils.handle_command({"type": "parentheses", "string": "".join(chunks)}))
+        assert stream_parentheses(client, chunks) == expected
+        assert "parentheses_depth" not in client
+    response = server_utils.handle_message(b'{"type": "parentheses_chunk", "string": "()"}', client, {})
+    assert response == server_utils.NO_PARENTHESES_STREAM
+
+
+def test_caesar_stream_answers_every_chunk_in_order():
+    client = authenticated_client()
+    send = lambda message: json.loads(server_utils.handle_message(json.dumps(message).encode(), client, {}))
+    assert send({"type": "caesar_chunk", "seq": 0, "text": "abc"})["message"] == "No caesar stream is open."
+    assert send({"type": "caesar_begin", "shift": 1}) == {"type": "caesar_continue"}
+    assert send({"type": "caesar_chunk", "seq": 0, "text": "Hello "}) == {"type": "caesar_chunk", "seq": 0, "result": "ifmmp "}
+    assert send({"type": "caesar_chunk", "seq": 5, "text": "x"}) == {"type": "error", "message": "Expected chunk 1.", "seq": 5}
+    assert send({"type": "caesar_chunk", "seq": 1, "text": "w0rld"})["type"] == "error"
+    assert send({"type": "caesar_chunk", "seq": 2, "text": "World"}) == {"type": "caesar_chunk", "seq": 2, "result": "xpsme"}
+    assert send({"type": "caesar_end"}) == {"type": "caesar_end", "chunks": 3}
+    assert "caesar_shift" not in client and "caesar_seq" not in client
+
+
+def test_caesar_stream_chunks_are_offloaded_like_caesar():
+    SERVER_OPTIONS["inline_cost"] = 5
+    client = authenticated_client()
+    server_utils.handle_message(b'{"type": "caesar_begin", "shift": 1}', client, {})
+    future = server_utils.handle_message(b'{"type": "caesar_chunk", "seq": 0, "text": "hello world"}', client, {}, Offloader("thread", 1))
+    assert is_pending(future)
+    assert json.loads(result_or_error(future)) == {"type": "caesar_chunk", "seq": 0, "result": "ifmmp xpsme"}
+
+
+def test_caesar_chunk_that_is_not_run_can_be_sent_again():
+    SERVER_OPTIONS.update(inline_cost=5, max_cost=100, command_rate=1.0, command_burst=3)
+    offloader = Offloader("thread", 1, max_pending=1)
+    release = threading.Event()
+    offloader.submit(release.wait)  # The pool is full
+    client = authenticated_client()
+    send = lambda message, limiters=None: server_utils.handle_message(json.dumps(message).encode(), client, {}, offloader, limiters)
+    send({"type": "caesar_begin", "shift": 1})
+    chunk = {"type": "caesar_chunk", "seq": 0, "text": "hello world"}
+    assert json.loads(send(chunk)) == dict(json.loads(BUSY_ERROR), seq=0)
+    assert json.loads(send(dict(chunk, text="x" * 101))) == dict(json.loads(server_utils.TOO_LARGE), seq=0)
+    limiters = server_utils.make_rate_limiters()
+    for _ in range(3):
+        send({"type": "caesar_chunk", "seq": 5, "text": "x"}, limiters)
+    assert json.loads(send(chunk, limiters)) == dict(json.loads(server_utils.THROTTLED), seq=0)
+    assert client["caesar_seq"] == 0
+    release.set()
+    offloader.release()
+    future = send(chunk)
+    assert json.loads(future.result(timeout=5)) == {"type": "caesar_chunk", "seq": 0, "result": "ifmmp xpsme"}
+    assert client["caesar_seq"] == 1
+
+
+def test_large_caesar_is_split_across_the_parallel_pool():
+    SERVER_OPTIONS.update(inline_cost=5, parallel_caesar=100)
+    offloader = Offloader("thread", 2, parallel=True)
+    try:
+        message = json.dumps({"type": "caesar", "text": "Hello World " * 50, "shift": 1}).encode()
+        future = server_utils.handle_message(message, authenticated_client(), {}, offloader)
+        assert is_pending(future)
+        assert json.loads(result_or_error(future)) == {"type": "caesar_result", "result": "ifmmp xpsme " * 50}
+        assert offloader.pending == 1
+    finally:
+        offloader.shutdown()
+
+
+def test_repeated_commands_are_answered_from_the_cache():
+    cache = server_utils.make_result_cache()
+    first = server_utils.handle_message(b'{"type": "lcm", "x": 4, "y": -6}', authenticated_client(), {}, None, None, cache)
+    # Same arguments in another order and sign, and a shift 26 apart: same responses
+    assert server_utils.handle_message(b'{"type": "lcm", "x": "6", "y": 4}', authenticated_client(), {}, None, None, cache) is first
+    assert json.loads(first) == {"type": "lcm_result", "result": 12}
+    caesar = server_utils.handle_message(b'{"type": "caesar", "text": "abc", "shift": 1}', authenticated_client(), {}, None, None, cache)
+    assert server_utils.handle_message(b'{"type": "caesar", "text": "abc", "shift": 27}', authenticated_client(), {}, None, None, cache) is caesar
+    assert server_utils.STATS["cache_hits"] >= 2 and "cache_hit_rate=" in server_utils.format_stats()
+    SERVER_OPTIONS["cache_min_cost"] = 10
+    server_utils.handle_message(b'{"type": "parentheses", "string": "()"}', authenticated_client(), {}, None, None, cache)
+    assert len(cache) == 2
+
+
+def test_offloaded_results_are_cached_when_they_complete():
+    SERVER_OPTIONS["inline_cost"] = 5
+    cache = server_utils.make_result_cache()
+    client = authenticated_client()
+    message = b'{"type": "caesar", "text": "hello world", "shift": 1}'
+    future = server_utils.handle_message(message, client, {}, Offloader("thread", 1), None, cache)
+    future.result()
+    response = server_utils.complete_offloaded(client, future)
+    assert server_utils.handle_message(message, client, {}, Offloader("thread", 1), None, cache) is response
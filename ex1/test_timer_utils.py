@@ -0,0 +1,38 @@
+# test_timer_utils.py
+from timer_utils import TimerWheel
+
+
+def test_timer_fires_once_its_deadline_passed():
+    wheel = TimerWheel(100.0, tick=0.5)
+    wheel.schedule(101.2, "a")
+    assert len(wheel) == 1
+    assert wheel.expire(101.0) == []
+    assert wheel.expire(101.5) == ["a"]
+    assert len(wheel) == 0 and wheel.expire(200.0) == []
+
+
+def test_timers_more_than_one_rotation_ahead_wait_for_their_turn():
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    wheel.schedule(3.0, "soon")
+    wheel.schedule(11.0, "later")  # Same slot as "soon", one rotation on
+    assert wheel.expire(3.0) == ["soon"]
+    assert wheel.expire(10.0) == []
+    assert wheel.expire(11.0) == ["later"]
+
+
+def test_a_long_stall_fires_everything_that_is_due():
+    wheel = TimerWheel(0.0, tick=1.0, slots=8)
+    for deadline in range(1, 30):
+        wheel.schedule(deadline, deadline)
+    assert sorted(wheel.expire(20.0)) == list(range(1, 21))
+    assert len(wheel) == 9
+
+
+def test_timeout_points_at_the_next_occupied_slot():
+    wheel = TimerWheel(10.0, tick=0.5)
+    assert wheel.timeout(10.0) is None
+    wheel.schedule(12.0, "a")
+    assert wheel.timeout(10.25) == 1.75
+    # A deadline already in the past is due at the next tick
+    wheel.schedule(5.0, "b")
+    assert wheel.timeout(10.25) == 0.25
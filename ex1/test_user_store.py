@@ -0,0 +1,49 @@
+# test_user_store.py
+import json
+
+from user_store import BloomFilter, UserStore, build_store, is_store
+
+
+def make_store(tmp_path, lines):
+    users_file = tmp_path / "users.txt"
+    users_file.write_text("".join(line + "\n" for line in lines))
+    path = str(tmp_path / "users.db")
+    build_store(str(users_file), path)
+    return path
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter.for_capacity(1000)
+    names = [f"user{i}" for i in range(1000)]
+    for name in names:
+        bloom.add(name)
+    assert all(name in bloom for name in names)
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 300  # Sized for 1%
+
+
+def test_store_answers_like_the_users_dict(tmp_path):
+    path = make_store(tmp_path, ["Alice\tsecret", "", "broken line", "Bob\tfirst", "Bob\tsecond"])
+    assert is_store(path) and not is_store(str(tmp_path / "users.txt"))
+    store = UserStore(path)
+    assert len(store) == 2
+    assert "Alice" in store and store["Alice"] == "secret"
+    assert store["Bob"] == "second"  # Later lines win, like load_users
+    assert "Carol" not in store and store.get("Carol") is None
+    store.close()
+
+
+def test_store_has_no_users_that_are_not_strings(tmp_path):
+    # A login_username message may carry any JSON value, or none at all
+    store = UserStore(make_store(tmp_path, ["Alice\tsecret", "5\tfive"]))
+    assert None not in store and 5 not in store and ["Alice"] not in store
+    assert store.get(5, "default") == "default"
+    assert json.loads('"\\ud800"') not in store
+    store.close()
+
+
+def test_store_replace_switches_to_the_rebuilt_store(tmp_path):
+    store = UserStore(make_store(tmp_path, ["Alice\ta"]))
+    store.replace(UserStore(make_store(tmp_path, ["Bob\tb"])))
+    assert "Alice" not in store and store["Bob"] == "b"
+    store.close()
@@ -0,0 +1,36 @@
+# test_vector_utils.py
+import math
+
+import vector_utils
+from vector_utils import lcm_many, parentheses_depth_array
+from server_utils import balanced_parentheses, parentheses_depth_chars
+
+# Small pairs, zeros, signs, and pairs whose inputs or lcm do not fit in int64
+XS = [4, 0, -6, 2 ** 40 + 3, 2 ** 63 - 1, -(2 ** 63), 2 ** 100, 3 ** 40, 12]
+YS = [6, 9, 4, 2 ** 40 + 5, 2, 3, 5, 2 ** 62 + 1, -(2 ** 100)]
+
+
+def test_lcm_many_matches_math_lcm():
+    assert lcm_many(XS, YS) == [math.lcm(x, y) for x, y in zip(XS, YS)]
+    assert all(type(result) is int for result in lcm_many(XS, YS))
+    assert lcm_many([], []) == []
+
+
+def test_lcm_many_without_numpy(monkeypatch):
+    monkeypatch.setattr(vector_utils, "np", None)
+    assert lcm_many(XS, YS) == [math.lcm(x, y) for x, y in zip(XS, YS)]
+
+
+def test_parentheses_array_matches_the_character_loop():
+    for s in ["()" * 200, "(" * 200 + ")" * 200, "(" * 201 + ")" * 200, ")(" * 200,
+              "()" * 199 + "(]", "()" * 199 + "é)", "()" * 100 + ")" + "(" + "()" * 99]:
+        for depth in (0, 1, 5):
+            assert parentheses_depth_array(s, depth) == parentheses_depth_chars(s, depth)
+        depth = parentheses_depth_chars(s)
+        assert balanced_parentheses(s) == (None if depth is None else depth == 0)
+
+
+def test_parentheses_without_numpy(monkeypatch):
+    monkeypatch.setattr(vector_utils, "np", None)
+    assert balanced_parentheses("(" * 300 + ")" * 300) is True
+    assert balanced_parentheses("()" * 300 + "x") is None
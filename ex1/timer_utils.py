@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+import math
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel for connection timeouts.
+
+    Time is cut into ticks of `tick` seconds and every timer goes into slot
+    (expiry tick % number of slots). Advancing the wheel only looks at the
+    slots of the ticks that passed, and finding the next wakeup only looks
+    at slots, so neither depends on how many connections are open.
+    Timers more than one rotation ahead stay in their slot until their
+    tick comes around.
+
+    There is no cancel: owners re-check their real deadline when a timer
+    fires, which keeps rescheduling on every bit of activity O(1).
+    """
+
+    def __init__(self, now, tick=0.5, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = self.to_tick(now)  # Last tick that was expired
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def to_tick(self, when):
+        return math.floor(when / self.tick)
+
+    def schedule(self, deadline, key):
+        """Have expire() return key once deadline (a time.monotonic value) has passed."""
+        expires = max(math.ceil(deadline / self.tick), self.current + 1)
+        self.slots[expires % len(self.slots)].append((expires, key))
+        self.count += 1
+
+    def expire(self, now):
+        """Return the keys of all timers that are due at time now."""
+        target = self.to_tick(now)
+        if target <= self.current:
+            return []
+        fired = []
+        # After a long stall every slot is visited once, not once per missed tick
+        ticks = min(target - self.current, len(self.slots))
+        for offset in range(1, ticks + 1):
+            index = (self.current + offset) % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            remaining = []
+            for expires, key in slot:
+                if expires <= target:
+                    fired.append(key)
+                else:
+                    remaining.append((expires, key))
+            self.slots[index] = remaining
+        self.current = target
+        self.count -= len(fired)
+        return fired
+
+    def timeout(self, now):
+        """
+        Seconds until the next occupied slot is due, for the selector's
+        timeout; None when no timers are scheduled.
+        """
+        if not self.count:
+            return None
+        for offset in range(1, len(self.slots) + 1):
+            if self.slots[(self.current + offset) % len(self.slots)]:
+                return max(0.0, (self.current + offset) * self.tick - now)
+        return None
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+"""
+On-disk user store for large account bases.
+
+    python3 user_store.py users_file.txt users.db
+
+builds a store from a tab-delimited users file (username<TAB>password).
+Pass the .db file to the server instead of the text file. Startup then
+reads only the Bloom filter, not the users, and logins look the user up
+in SQLite's index.
+"""
+import argparse
+import hashlib
+import math
+import os
+import sqlite3
+import sys
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+# Fraction of unknown usernames the Bloom filter lets through to SQLite
+BLOOM_FALSE_POSITIVES = 0.01
+
+# Bytes of the store SQLite maps into memory instead of reading with read()
+MMAP_SIZE = 1 << 30
+
+
+class BloomFilter:
+    """
+    Set membership in m bits with k hash functions: no false negatives, and
+    false positives at about the rate it was sized for. The k bit positions
+    come from one blake2b digest (double hashing).
+    """
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, count, false_positives=BLOOM_FALSE_POSITIVES):
+        count = max(count, 1)
+        bits = max(8, math.ceil(-count * math.log(false_positives) / math.log(2) ** 2))
+        return cls(bits, max(1, round(bits / count * math.log(2))))
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * step) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for bit in self.positions(key):
+            self.data[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        data = self.data
+        return all(data[bit >> 3] & (1 << (bit & 7)) for bit in self.positions(key))
+
+
+def is_store(path):
+    """True if path is a store built by build_store rather than a text users file."""
+    try:
+        with open(path, "rb") as file:
+            return file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+
+def build_store(users_file, path):
+    """
+    Build a store at path from a users file. Later lines win over earlier
+    ones for the same username, like load_users. The store is written next
+    to path and renamed over it, so a running server never sees half of it.
+    Returns the number of users.
+    """
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    db = sqlite3.connect(temp_path)
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        # Clustered on username: a lookup is one B-tree descent, with no separate index
+        db.execute("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT NOT NULL) WITHOUT ROWID")
+        db.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value) WITHOUT ROWID")
+        with open(users_file, "r", encoding="utf-8") as file:
+            db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)", read_entries(file))
+        count = db.execute("SELECT count(*) FROM users").fetchone()[0]
+        bloom = BloomFilter.for_capacity(count)
+        for (username,) in db.execute("SELECT username FROM users"):
+            bloom.add(username)
+        db.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("count", count), ("bloom_bits", bloom.bits), ("bloom_hashes", bloom.hashes), ("bloom", bytes(bloom.data)),
+        ])
+        db.commit()
+    finally:
+        db.close()
+    os.replace(temp_path, path)
+    return count
+
+
+def read_entries(file):
+    """(username, password) for every valid line of a users file, parsed like load_users."""
+    for line in file:
+        parts = line.strip().split("\t")
+        if len(parts) == 2:
+            yield parts[0].strip(), parts[1].strip()
+
+
+class UserStore:
+    """
+    Read-only view of a store with the part of the dict interface the server
+    uses (in, [], get, len). Unknown usernames are answered by the Bloom
+    filter without a query; known ones cost one index lookup.
+    """
+
+    def __init__(self, path):
+        # The reload thread opens replacements that the loop thread then uses
+        self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.db.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        meta = dict(self.db.execute("SELECT name, value FROM meta"))
+        self.count = meta["count"]
+        self.bloom = BloomFilter(meta["bloom_bits"], meta["bloom_hashes"], meta["bloom"])
+
+    def __len__(self):
+        return self.count
+
+    def get(self, username, default=None):
+        # Clients may send any JSON value as a username; only strings can be users
+        if not isinstance(username, str):
+            return default
+        try:
+            if username not in self.bloom:
+                return default
+        except UnicodeEncodeError:
+            return default  # A lone surrogate ("\ud800" in JSON): not UTF-8, so not in a users file
+        row = self.db.execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row is not None else default
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def __getitem__(self, username):
+        password = self.get(username)
+        if password is None:
+            raise KeyError(username)
+        return password
+
+    def replace(self, other):
+        """Take over other's contents in place, so everyone holding this store sees the new users."""
+        old = self.db
+        self.db, self.count, self.bloom = other.db, other.count, other.bloom
+        old.close()
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a user store from a tab-delimited users file")
+    parser.add_argument("users_file", help="username<TAB>password per line")
+    parser.add_argument("store", help="Path of the store to write, e.g. users.db")
+    args = parser.parse_args()
+    count = build_store(args.users_file, args.store)
+    print(f"Wrote {count} users to {args.store}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
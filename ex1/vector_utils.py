@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+"""
+Bulk versions of the server's commands. They use NumPy when it is
+installed and fall back to plain Python with the same results otherwise.
+"""
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Largest magnitude computed in int64; -2**63 is left out because abs() of it overflows
+INT64_LIMIT = 2 ** 63 - 1
+
+
+def to_int64(values):
+    """
+    values as an int64 array, plus a boolean array marking the values whose
+    magnitude does not fit (stored as 0).
+    """
+    try:
+        array = np.array(values, dtype=np.int64)
+    except OverflowError:
+        objects = np.array(values, dtype=object)
+        big = (objects > INT64_LIMIT) | (objects < -INT64_LIMIT)
+        return np.where(big, 0, objects).astype(np.int64), big.astype(bool)
+    big = array < -INT64_LIMIT
+    return np.where(big, 0, array), big
+
+
+def lcm_many(xs, ys):
+    """
+    Element-wise lcm of two equally long lists of ints, as a list of ints.
+
+    With NumPy every pair whose inputs and result fit in int64 is computed
+    in one vectorized pass (|x| // gcd * |y|, checked for overflow before
+    multiplying); only the remaining pairs go through Python's big ints.
+    """
+    if np is None or not xs:
+        return [math.lcm(x, y) for x, y in zip(xs, ys)]
+    a, a_big = to_int64(xs)
+    b, b_big = to_int64(ys)
+    a = np.abs(a)
+    b = np.abs(b)
+    q = a // np.maximum(np.gcd(a, b), 1)
+    overflow = q > INT64_LIMIT // np.maximum(b, 1)
+    results = (q * np.where(overflow, 0, b)).tolist()
+    # Pairs that overflow int64 are redone exactly
+    for i in np.flatnonzero(overflow | a_big | b_big).tolist():
+        results[i] = math.lcm(xs[i], ys[i])
+    return results
+
+
+if np is not None:
+    # Depth change per byte of a parentheses string; 0 marks a byte that is not allowed
+    PARENTHESES_STEPS = np.zeros(256, dtype=np.int8)
+    PARENTHESES_STEPS[ord("(")] = 1
+    PARENTHESES_STEPS[ord(")")] = -1
+
+
+def parentheses_depth_array(s, depth=0):
+    """
+    parentheses_depth for long strings, with NumPy: one table lookup maps
+    every byte to +1, -1 or 0 (invalid), and the running sum of the steps is
+    the depth after each character.
+    """
+    if not s.isascii():
+        return None
+    steps = PARENTHESES_STEPS[np.frombuffer(s.encode("ascii"), dtype=np.uint8)]
+    if not steps.all():
+        return None
+    depths = np.cumsum(steps, dtype=np.int32 if len(steps) < 2 ** 31 else np.int64)
+    if depth + int(depths.min()) < 0:
+        return -1
+    return depth + int(depths[-1])
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import gc, os, signal, sys, time
+import general_utils
+from general_utils import print_strings
+
+# A worker that dies sooner than this after being started is restarted
+# only after a pause, so a worker that crashes on startup cannot turn the
+# supervisor into a fork loop.
+MIN_WORKER_LIFETIME = 1.0
+
+# Passed on from the supervisor to every worker (reload users, print stats)
+FORWARDED_SIGNALS = [getattr(signal, name) for name in ("SIGHUP", "SIGUSR1") if hasattr(signal, name)]
+
+
+def spawn_worker(index, worker_main):
+    """
+    Fork one worker process running worker_main(index). Returns the child pid
+    in the supervisor; the child never returns from this function.
+    """
+    pid = os.fork()
+    if pid != 0:
+        return pid
+
+    # Child: the supervisor's handlers must not run here.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    for signum in FORWARDED_SIGNALS:
+        signal.signal(signum, signal.SIG_IGN)  # Until the worker installs its own handler
+    code = 0
+    try:
+        worker_main(index)
+    except KeyboardInterrupt:
+        pass
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except BaseException as e:
+        print(f"SERVER: Worker {index} crashed: {e!r}", file=sys.stderr, flush=True)
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def supervise(count, worker_main):
+    """
+    Fork count workers and keep them running: a worker that exits is
+    restarted in its slot until the supervisor gets SIGINT or SIGTERM, which
+    is forwarded to all workers. SIGHUP and SIGUSR1 are forwarded too, so
+    that every worker reloads the users file or prints its stats.
+
+    Everything loaded before calling this (e.g. the users dict) is shared with
+    the workers copy-on-write. gc.freeze() moves those objects out of the
+    collector's reach so that collections in the workers do not touch, and so
+    copy, their pages.
+    """
+    if not hasattr(os, "fork"):
+        print("Multiple workers need os.fork, which this platform does not have.")
+        sys.exit(1)
+
+    gc.freeze()
+    workers = {}  # pid -> (index, start time)
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def forward(signum, frame):
+        # Every worker holds its own users and stats; each handles the signal itself
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for signum in FORWARDED_SIGNALS:
+        signal.signal(signum, forward)
+
+    for index in range(count):
+        workers[spawn_worker(index, worker_main)] = (index, time.monotonic())
+    print_strings(general_utils.verbose, f"SERVER: Supervisor {os.getpid()} started {count} workers")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started = workers.pop(pid)
+        if stopping:
+            continue
+        print(f"SERVER: Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting", flush=True)
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)
+        if not stopping:
+            pid = spawn_worker(index, worker_main)
+            workers[pid] = (index, time.monotonic())
+            if stopping:
+                os.kill(pid, signal.SIGTERM)